@@ -7,23 +7,24 @@ from django.utils.translation import gettext_lazy as _
 from cabinet.base_admin import FileAdminBase
 from cabinet.ckeditor import CKEditorFilebrowserMixin
 from cabinet.models import File
+from cabinet.renditions import ADMIN_THUMBNAIL, rendition_url
 
 
 @admin.register(File)
 class FileAdmin(CKEditorFilebrowserMixin, FileAdminBase):
     list_display = ["admin_thumbnail", "admin_file_name", "admin_details"]
     list_display_links = ["admin_thumbnail", "admin_file_name"]
+    search_fields = ["file_name", "caption", "copyright"]
 
     @admin.display(description="")
     def admin_thumbnail(self, instance):
         if instance.image_file.name:
-            try:
-                target = instance.image_file.process(["default", ("crop", (50, 50))])
-                return format_html(
-                    '<img src="{}" alt=""/>', instance.image_file.storage.url(target)
-                )
-            except Exception:
+            url = rendition_url(instance.image_file, ADMIN_THUMBNAIL)
+            if url is None:
+                return mark_safe('<span class="pending-image"></span>')
+            elif not url:
                 return mark_safe('<span class="broken-image"></span>')
+            return format_html('<img src="{}" alt=""/>', url)
         elif instance.download_file.name:
             return format_html(
                 '<span class="download download-{}">{}</span>',
@@ -1,9 +1,15 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 from django.utils.translation import gettext_lazy as _
 
+from cabinet.search import prepare_search_index
+
 
 class CabinetConfig(AppConfig):
     default_auto_field = "django.db.models.AutoField"
 
     name = "cabinet"
     verbose_name = _("Cabinet media library")
+
+    def ready(self):
+        post_migrate.connect(prepare_search_index, sender=self)
@@ -1,46 +1,139 @@
+import hashlib
 import inspect
-import io
 import os
-import re
 
+from django.conf import settings
 from django.core.exceptions import (
     FieldDoesNotExist,
     ImproperlyConfigured,
     ValidationError,
 )
-from django.db import models
+from django.db import models, router, transaction
 from django.db.models import signals
+from django.db.models.fields.files import FieldFile
 from django.utils.translation import gettext_lazy as _
 from imagefield.fields import ImageField, PPOIField
 from PIL import Image
 from tree_queries.fields import TreeNodeForeignKey
 
+from cabinet.deletion import schedule_deletion
+from cabinet.renditions import forget_renditions, schedule_renditions
+from cabinet.search import get_search_backend
+
 
 UPLOAD_TO = "cabinet/%Y/%m"
 
 
-def upload_is_image(data):
+def content_hash(file):
+    """
+    Return the hex SHA-256 digest of ``file``, read in chunks
+    """
+    h = hashlib.sha256()
+    for chunk in file.chunks():
+        h.update(chunk.encode() if isinstance(chunk, str) else chunk)
+    return h.hexdigest()
+
+
+def lock_shared_files(model):
+    """
+    Return whether files referencing a blob should be locked before sharing
+    the blob, i.e. whether a transaction is active
+    """
+    return transaction.get_connection(router.db_for_write(model)).in_atomic_block
+
+
+def upload_metadata(file):
+    """
+    Return the metadata collected by ``cabinet.uploadhandlers`` while
+    receiving ``file`` (an uploaded file or a field file which hasn't been
+    committed yet), or ``None``
+    """
+    return getattr(file, "cabinet_metadata", None) or getattr(
+        getattr(file, "_file", None), "cabinet_metadata", None
+    )
+
+
+def max_image_pixels():
+    """
+    Return the decompression bomb limit for uploaded images
+
+    Defaults to Pillow's ``Image.MAX_IMAGE_PIXELS``, set
+    ``CABINET_MAX_IMAGE_PIXELS`` to a lower value to reject large images
+    earlier (``None`` disables this check). Pillow itself still refuses to
+    open images with more than twice ``Image.MAX_IMAGE_PIXELS`` pixels; raise
+    ``Image.MAX_IMAGE_PIXELS`` to accept larger images.
+    """
+    return getattr(settings, "CABINET_MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+
+
+def upload_is_image(data, *, verify=False):
     """
     Determine whether ``data`` is an image or not
 
+    Only the image header is read to determine the format and the dimensions,
+    the upload is never loaded into memory as a whole. Images with more than
+    ``max_image_pixels()`` pixels are rejected. Pass ``verify=True`` to also
+    decode the image data; ``verify_image`` does the same for files which
+    have already been stored.
+
     Usage::
 
         if upload_is_image(request.FILES['file']):
             ...
     """
+    if metadata := upload_metadata(data):
+        info = metadata["image"]
+        if info is False:
+            return False
+        elif info:
+            limit = max_image_pixels()
+            if limit and info["width"] * info["height"] > limit:
+                return False
+            elif not verify:
+                return True
+            elif "verified" in info:
+                # Decoded while receiving the upload
+                return info["verified"]
+
     # From django/forms/fields.py
     if hasattr(data, "temporary_file_path"):
         file = data.temporary_file_path()
     else:
-        file = io.BytesIO(data.read())
+        file = data
+        file.seek(0)
+
+    try:
+        return _is_image(file, verify=verify)
+    finally:
+        if file is data:
+            data.seek(0)
 
+
+def verify_image(file):
+    """
+    Fully decode ``file`` (a path or a file-like object) and return whether
+    it contains intact image data
+
+    Usage::
+
+        with instance.image_file.open("rb") as f:
+            if not verify_image(f):
+                ...
+    """
+    return _is_image(file, verify=True)
+
+
+def _is_image(file, *, verify):
+    limit = max_image_pixels()
     try:
-        image = Image.open(file)
-        image.resize([20, 20], Image.LANCZOS)  # Verify image some more
-        with io.BytesIO() as buf:
-            image.save(buf, image.format)
+        with Image.open(file) as image:
+            width, height = image.size
+            if limit and width * height > limit:
+                return False
+            if verify:
+                image.load()
         return True
-    except Exception:  # OSError, errors while resizing
+    except Exception:  # OSError, DecompressionBombError, truncated data
         return False
 
 
@@ -70,57 +163,153 @@ class ImageMixin(models.Model):
         verbose_name = _("image")
         verbose_name_plural = _("images")
 
+    def prepare_save(self):
+        # Renditions of new uploads are generated after saving, see
+        # cabinet.renditions
+        self._renditions_pending = bool(
+            self.image_file.name and not self.image_file._committed
+        )
+        # django-imagefield's post_save handler would generate them during
+        # the request too; it still generates missing formats when files are
+        # saved again
+        self._skip_generate_files = self._renditions_pending
+        if hasattr(super(), "prepare_save"):
+            super().prepare_save()
+
+    prepare_save.alters_data = True
+
     def accept_file(self, value):
-        if upload_is_image(value):
+        # django-imagefield decodes the image when saving it anyway if
+        # IMAGEFIELD_VALIDATE_ON_SAVE is set, so corrupt images have to be
+        # rejected here already.
+        if upload_is_image(value, verify=settings.IMAGEFIELD_VALIDATE_ON_SAVE):
             self.image_file = value
             return True
 
 
+#: Signatures used to classify files with unknown extensions. Each entry is
+#: a download type and a tuple of ``(offset, bytes)`` pairs which all have to
+#: match. Types which are missing in ``DOWNLOAD_TYPES`` are ignored.
+MAGIC_BYTES = [
+    ("image", ((0, b"\xff\xd8\xff"),)),
+    ("image", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    ("image", ((0, b"GIF87a"),)),
+    ("image", ((0, b"GIF89a"),)),
+    ("image", ((0, b"II*\x00"),)),
+    ("image", ((0, b"MM\x00*"),)),
+    ("image", ((0, b"RIFF"), (8, b"WEBP"))),
+    ("image", ((0, b"\x00\x00\x00\x0cjP  \r\n\x87\n"),)),
+    ("video", ((4, b"ftyp"),)),
+    ("video", ((0, b"RIFF"), (8, b"AVI "))),
+    ("video", ((0, b"\x1a\x45\xdf\xa3"),)),
+    ("video", ((0, b"FLV\x01"),)),
+    ("video", ((0, b"\x00\x00\x01\xba"),)),
+    ("video", ((0, b"\x00\x00\x01\xb3"),)),
+    ("audio", ((0, b"ID3"),)),
+    ("audio", ((0, b"RIFF"), (8, b"WAVE"))),
+    ("audio", ((0, b"fLaC"),)),
+    ("audio", ((0, b".snd"),)),
+    ("pdf", ((0, b"%PDF-"),)),
+    ("swf", ((0, b"FWS"),)),
+    ("swf", ((0, b"CWS"),)),
+    ("swf", ((0, b"ZWS"),)),
+    ("rtf", ((0, b"{\\rtf"),)),
+    ("zip", ((0, b"PK\x03\x04"),)),
+]
+
+#: Number of bytes needed to check all ``MAGIC_BYTES``
+MAGIC_BYTES_LENGTH = 32
+
+
+class DownloadTypeClassifier:
+    """
+    Classifies files using the entries of ``DownloadMixin.DOWNLOAD_TYPES``
+
+    The third element of entries is either a tuple of file name extensions
+    (e.g. ``(".jpg", ".jpeg")``), which are collected into a single lookup
+    table, or a callable receiving the file name. Callables are evaluated in
+    order, but only those preceding the entry of the file's extension. The
+    last entry is the fallback. Files whose extension is unknown are
+    classified by their first bytes using ``MAGIC_BYTES`` before falling
+    back.
+    """
+
+    def __init__(self, download_types):
+        *entries, (self.fallback, _title, _check) = download_types
+        self.extensions = {}
+        self.checks = []
+        for position, (type, _title, check) in enumerate(entries):
+            if callable(check):
+                self.checks.append((position, type, check))
+            else:
+                for extension in check:
+                    self.extensions.setdefault(extension.lower(), (position, type))
+
+        types = {type for type, _title, _check in entries}
+        self.magic = [row for row in MAGIC_BYTES if row[0] in types]
+
+    def __call__(self, name, head=b""):
+        return self.by_name(name) or self.by_content(head) or self.fallback
+
+    def by_name(self, name):
+        position, type = self.extensions.get(
+            os.path.splitext(name)[1].lower(), (None, None)
+        )
+        for check_position, check_type, check in self.checks:
+            if position is not None and check_position > position:
+                break
+            if check(name):
+                return check_type
+        return type
+
+    def by_content(self, head):
+        for type, signature in self.magic:
+            if all(
+                head[offset : offset + len(value)] == value
+                for offset, value in signature
+            ):
+                return type
+        return None
+
+
 class DownloadMixin(models.Model):
-    DOWNLOAD_TYPES = [  # pragma: no branch (last condition always matches)
-        # Should we be using imghdr.what instead of extension guessing?
+    DOWNLOAD_TYPES = [
         (
             "image",
             _("Image"),
-            lambda f: re.compile(
-                r"\.(bmp|jpe?g|jp2|jxr|gif|png|tiff?)$", re.IGNORECASE
-            ).search(f),
+            (".bmp", ".jpg", ".jpeg", ".jp2", ".jxr", ".gif", ".png", ".tif", ".tiff"),
         ),
         (
             "video",
             _("Video"),
-            lambda f: re.compile(
-                r"\.(mov|m[14]v|mp4|avi|mpe?g|qt|ogv|wmv|flv)$", re.IGNORECASE
-            ).search(f),
+            (
+                ".mov",
+                ".m1v",
+                ".m4v",
+                ".mp4",
+                ".avi",
+                ".mpg",
+                ".mpeg",
+                ".qt",
+                ".ogv",
+                ".wmv",
+                ".flv",
+            ),
         ),
         (
             "audio",
             _("Audio"),
-            lambda f: re.compile(
-                r"\.(au|mp3|m4a|wma|oga|ram|wav)$", re.IGNORECASE
-            ).search(f),
-        ),
-        ("pdf", _("PDF document"), lambda f: f.lower().endswith(".pdf")),
-        ("swf", _("Flash"), lambda f: f.lower().endswith(".swf")),
-        ("txt", _("Text"), lambda f: f.lower().endswith(".txt")),
-        ("rtf", _("Rich Text"), lambda f: f.lower().endswith(".rtf")),
-        ("zip", _("Zip archive"), lambda f: f.lower().endswith(".zip")),
-        (
-            "doc",
-            _("Microsoft Word"),
-            lambda f: re.compile(r"\.docx?$", re.IGNORECASE).search(f),
-        ),
-        (
-            "xls",
-            _("Microsoft Excel"),
-            lambda f: re.compile(r"\.xlsx?$", re.IGNORECASE).search(f),
+            (".au", ".mp3", ".m4a", ".wma", ".oga", ".ram", ".wav"),
         ),
-        (
-            "ppt",
-            _("Microsoft PowerPoint"),
-            lambda f: re.compile(r"\.pptx?$", re.IGNORECASE).search(f),
-        ),
-        ("other", _("Binary"), lambda f: True),  # Must be last
+        ("pdf", _("PDF document"), (".pdf",)),
+        ("swf", _("Flash"), (".swf",)),
+        ("txt", _("Text"), (".txt",)),
+        ("rtf", _("Rich Text"), (".rtf",)),
+        ("zip", _("Zip archive"), (".zip",)),
+        ("doc", _("Microsoft Word"), (".doc", ".docx")),
+        ("xls", _("Microsoft Excel"), (".xls", ".xlsx")),
+        ("ppt", _("Microsoft PowerPoint"), (".ppt", ".pptx")),
+        ("other", _("Binary"), ()),  # Must be last
     ]
 
     download_file = models.FileField(
@@ -133,19 +322,50 @@ class DownloadMixin(models.Model):
         verbose_name = _("download")
         verbose_name_plural = _("downloads")
 
-    def save(self, *args, **kwargs):
-        self.download_type = (  # pragma: no branch
-            next(
-                type
-                for type, title, check in self.DOWNLOAD_TYPES
-                if check(self.download_file.name)
-            )
-            if self.download_file
-            else ""
-        )
-        super().save(*args, **kwargs)
+    @classmethod
+    def download_type_classifier(cls):
+        # Built once per class, subclasses may override DOWNLOAD_TYPES
+        if "_download_type_classifier" not in cls.__dict__:
+            cls._download_type_classifier = DownloadTypeClassifier(cls.DOWNLOAD_TYPES)
+        return cls._download_type_classifier
+
+    @classmethod
+    def classify(cls, name, head_bytes=b""):
+        """
+        Return the download type of a file named ``name`` starting with
+        ``head_bytes``
+        """
+        return cls.download_type_classifier()(name, head_bytes)
+
+    def prepare_save(self):
+        f_obj = self.download_file
+        if not f_obj:
+            self.download_type = ""
+        else:
+            classifier = self.download_type_classifier()
+            type = classifier.by_name(f_obj.name)
+            if type:
+                pass
+            elif not f_obj._committed:
+                # Sniff new uploads only, never ask the storage for data.
+                if metadata := upload_metadata(f_obj):
+                    head = metadata["head"]
+                else:
+                    f_obj.file.seek(0)
+                    head = f_obj.file.read(MAGIC_BYTES_LENGTH)
+                    f_obj.file.seek(0)
+                type = classifier.by_content(head)
+            elif (
+                getattr(self, "_loaded_state", {}).get(f_obj.field.attname)
+                == f_obj.name
+            ):
+                # Keep the type sniffed when the unchanged file was uploaded
+                type = self.download_type
+            self.download_type = type or classifier.fallback
+        if hasattr(super(), "prepare_save"):
+            super().prepare_save()
 
-    save.alters_data = True
+    prepare_save.alters_data = True
 
     def accept_file(self, value):
         self.download_file = value
@@ -166,15 +386,20 @@ class OverwriteMixin(models.Model):
         abstract = True
 
     def save(self, *args, **kwargs):
-        original = None
-        if self.pk:
-            original = self.__class__._base_manager.filter(pk=self.pk).first()
-
-        if self._overwrite and original and not self.file._committed:
+        original = self._original() if self.pk else None
+
+        if (
+            self._overwrite
+            and original
+            and not self.file._committed
+            # Never overwrite blobs shared with other files
+            and not original._file_is_shared(original.file)
+        ):
             original_file = original.file
             original_file_name = original_file.name
             original.delete_files()
             original_file.delete(save=False)
+            forget_renditions(original_file)
 
             new_file = self.file
             new_file.storage.save(
@@ -223,9 +448,25 @@ class AbstractFile(TimestampsMixin):
 
     file_name = models.CharField(_("file name"), max_length=1000)
     file_size = models.PositiveIntegerField(_("file size"))
+    file_hash = models.CharField(
+        _("file hash"), max_length=64, blank=True, editable=False, db_index=True
+    )
+    # Name of the filled in file field, used for filtering by type
+    kind = models.CharField(_("kind"), max_length=50, blank=True, editable=False)
 
     class Meta:
         abstract = True
+        indexes = [
+            # Used by the changelist's keyset pagination
+            models.Index(
+                fields=["folder", "file_name", "id"],
+                name="%(app_label)s_%(class)s_keyset",
+            ),
+            models.Index(
+                fields=["folder", "kind"],
+                name="%(app_label)s_%(class)s_kind",
+            ),
+        ]
         ordering = ["file_name"]
         verbose_name = _("file")
         verbose_name_plural = _("files")
@@ -234,21 +475,215 @@ class AbstractFile(TimestampsMixin):
         return self.file_name
 
     def save(self, *args, **kwargs):
-        f_obj = self.file
-        self.file_name = os.path.basename(f_obj.name)
-        self.file_size = f_obj.size
-        super().save(*args, **kwargs)
+        using = kwargs.get("using") or router.db_for_write(
+            self.__class__, instance=self
+        )
+        # Deduplication locks the file referencing the reused blob until the
+        # new file has been saved, see _deduplicate()
+        with transaction.atomic(using=using, savepoint=False):
+            self.prepare_save()
+            original = self._original() if self.pk else None
+            super().save(*args, **kwargs)
+
+            update_fields = kwargs.get("update_fields")
+            folder_id, file_size = self.folder_id, self.file_size
+            # Only count the saved values
+            if original is not None and update_fields is not None:
+                if not {"folder", "folder_id"} & set(update_fields):
+                    folder_id = original.folder_id
+                if "file_size" not in update_fields:
+                    file_size = original.file_size
+
+            if original is None:
+                self.update_folder_counters(folder_id, 1, file_size)
+            elif original.folder_id != folder_id:
+                self.update_folder_counters(original.folder_id, -1, -original.file_size)
+                self.update_folder_counters(folder_id, 1, file_size)
+            elif original.file_size != file_size:
+                self.update_folder_counters(
+                    folder_id, 0, file_size - original.file_size
+                )
+        self._snapshot(update_fields)
 
     save.alters_data = True
 
-    def delete_files(self):
-        for field in self.FILE_FIELDS:
-            f_obj = getattr(self, field)
-            if not f_obj.name:
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # Only record the reloaded fields, other fields may have been modified
+        self._snapshot(fields)
+
+    @classmethod
+    def update_folder_counters(cls, folder_id, num_files, size):
+        """
+        Update the file counters of a folder and its ancestors
+
+        ``save()`` and deletions take care of this; code using
+        ``bulk_create()`` or ``update()`` has to call it itself.
+        """
+        cls._meta.get_field("folder").related_model.update_counters(
+            folder_id,
+            num_files=num_files,
+            num_files_recursive=num_files,
+            size_recursive=size,
+        )
+
+    def _snapshot(self, fields=None):
+        """
+        Remember the database state of the loaded concrete fields
+
+        ``_original()`` uses this state to compare the current file with the
+        file stored in the database without querying the database again.
+        """
+        state = {} if fields is None else getattr(self, "_loaded_state", {})
+        for field in self._meta.concrete_fields:
+            if field.attname not in self.__dict__ or (
+                fields is not None
+                and field.name not in fields
+                and field.attname not in fields
+            ):
                 continue
+            value = self.__dict__[field.attname]
+            state[field.attname] = value.name if isinstance(value, FieldFile) else value
+        self._loaded_state = state
+
+    def _original(self):
+        """
+        Return an instance representing the row as it was loaded or saved
+
+        Falls back to a query if the instance wasn't loaded from the database
+        or if file fields have been deferred.
+        """
+        state = getattr(self, "_loaded_state", None)
+        if (
+            not state
+            or state.get(self._meta.pk.attname) != self.pk
+            or any(
+                self._meta.get_field(field).attname not in state
+                for field in self.FILE_FIELDS
+            )
+        ):
+            original = self.__class__._base_manager.filter(pk=self.pk).first()
+            if original is not None:
+                # Do not query again when calling _original() again
+                self._loaded_state = original._loaded_state
+            return original
+        field_names = [
+            field.attname
+            for field in self._meta.concrete_fields
+            if field.attname in state
+        ]
+        return self.__class__.from_db(
+            self._state.db, field_names, [state[name] for name in field_names]
+        )
+
+    def prepare_save(self):
+        """
+        Fill in the fields derived from the file
 
-            # f_obj.storage.delete(f_obj.name)
-            f_obj.delete(save=False)
+        ``save()`` calls this method; code inserting files using
+        ``bulk_create()`` has to call it itself. Mixins may extend this method
+        too, they have to call ``super().prepare_save()`` if it exists.
+        """
+        f_obj = self.file
+        self.kind = f_obj.field.name
+        # Deduplicated uploads keep their own name when they are saved again,
+        # the name is only derived from new uploads and replaced blobs
+        state = getattr(self, "_loaded_state", None)
+        if (
+            not self.file_name
+            or not f_obj._committed
+            or (state and state.get(f_obj.field.attname) != f_obj.name)
+        ):
+            self.file_name = os.path.basename(f_obj.name)
+        if not f_obj._committed or self.file_size is None:
+            # Avoid asking the storage for the size of unchanged files
+            self.file_size = f_obj.size
+        if not f_obj._committed:
+            metadata = upload_metadata(f_obj)
+            self.file_hash = metadata["hash"] if metadata else content_hash(f_obj.file)
+            if getattr(settings, "CABINET_DEDUPLICATE_FILES", False) and not getattr(
+                self, "_overwrite", False
+            ):
+                self._deduplicate(f_obj)
+        if hasattr(super(), "prepare_save"):
+            super().prepare_save()
+
+    prepare_save.alters_data = True
+
+    def share_file(self, other):
+        """
+        Reference the blob of ``other`` and copy the fields derived from it
+        (all non-editable fields, the file size and the hash) without
+        touching the storage. Only use this with ``CABINET_DEDUPLICATE_FILES``
+        so that the blob is only deleted with its last reference.
+        """
+        for field in self._meta.concrete_fields:
+            if field.primary_key or getattr(field, "auto_now", False):
+                continue
+            if (
+                not field.editable
+                or field.name in self.FILE_FIELDS
+                or field.name in {"file_size", "file_hash"}
+            ):
+                # Bypass descriptors (e.g. the image dimension update)
+                self.__dict__[field.attname] = other.__dict__[field.attname]
+
+    share_file.alters_data = True
+
+    def _deduplicate(self, f_obj):
+        """
+        Point ``f_obj`` at an existing blob with the same content instead of
+        storing the upload again
+
+        Inside transactions, the file referencing the blob is locked so that
+        deleting it (and its blob) waits until the new file has been saved.
+        A file deleted in the meantime isn't found anymore.
+        """
+        field = f_obj.field
+        queryset = self.__class__._base_manager.filter(
+            file_hash=self.file_hash
+        ).exclude(**{field.name: ""})
+        if lock_shared_files(self.__class__):
+            queryset = queryset.select_for_update()
+        existing = queryset.values_list(field.name, flat=True).first()
+        if existing:
+            # Bypass the descriptor; the image dimensions are known already.
+            self.__dict__[field.attname] = existing
+
+    def _file_is_shared(self, f_obj):
+        """
+        Return whether other files reference the blob of ``f_obj`` too
+
+        Blobs are only shared when using ``CABINET_DEDUPLICATE_FILES``, but
+        the check also protects blobs shared before it has been switched off.
+        """
+        if not self.file_hash:
+            return False
+        return (
+            self.__class__._base_manager.filter(
+                file_hash=self.file_hash, **{f_obj.field.name: f_obj.name}
+            )
+            .exclude(pk=self.pk)
+            .exists()
+        )
+
+    def delete_files(self):
+        """
+        Delete the blobs of the file once the transaction has been committed
+
+        Blobs which are referenced by other files at that time are kept, see
+        ``cabinet.deletion``.
+        """
+        schedule_deletion(
+            [getattr(self, field) for field in self.FILE_FIELDS],
+            using=self._state.db,
+        )
 
     delete_files.alters_data = True
 
@@ -317,3 +752,26 @@ def determine_accept_file_functions(sender, **kwargs):
 
 
 signals.class_prepared.connect(determine_accept_file_functions)
+
+
+def update_search_index(sender, instance, **kwargs):
+    get_search_backend().index([instance])
+
+
+def generate_renditions(sender, instance, using, **kwargs):
+    schedule_renditions([instance], using=using)
+
+
+def handle_file_deletion(sender, instance, **kwargs):
+    instance.update_folder_counters(instance.folder_id, -1, -instance.file_size)
+    get_search_backend().remove([instance])
+
+
+def connect_file_signals(sender, **kwargs):
+    if issubclass(sender, AbstractFile) and not sender._meta.abstract:
+        signals.post_save.connect(update_search_index, sender=sender)
+        signals.post_save.connect(generate_renditions, sender=sender)
+        signals.post_delete.connect(handle_file_deletion, sender=sender)
+
+
+signals.class_prepared.connect(connect_file_signals)
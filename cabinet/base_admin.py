@@ -1,15 +1,26 @@
-from urllib.parse import urlencode
+import copy
+import json
+import os
+import secrets
+from urllib.parse import quote, urlencode
 
 import django
 from django import forms
+from django.conf import settings
 from django.contrib import admin, messages
 from django.contrib.admin import helpers
 from django.contrib.admin.options import IncorrectLookupParameters
-from django.contrib.admin.views.main import SEARCH_VAR
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, SEARCH_VAR, ChangeList
+from django.core.cache import cache
 from django.core.exceptions import FieldDoesNotExist, PermissionDenied, ValidationError
-from django.db import router, transaction
-from django.db.models import Count
-from django.http import HttpResponseRedirect, JsonResponse
+from django.db import connections, router, transaction
+from django.db.models import Count, Q, Sum
+from django.http import (
+    HttpResponseRedirect,
+    JsonResponse,
+    QueryDict,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404
 from django.urls import path, re_path, reverse
 from django.utils.functional import cached_property
@@ -17,7 +28,16 @@ from django.utils.text import capfirst
 from django.utils.translation import gettext_lazy as _
 from tree_queries.forms import TreeNodeChoiceField
 
+from cabinet.archive import stream_zip
+from cabinet.deletion import delete_blobs, unreferenced_files
 from cabinet.models import Folder
+from cabinet.renditions import (
+    ADMIN_THUMBNAIL,
+    prefetch_renditions,
+    schedule_renditions,
+)
+from cabinet.search import get_search_backend
+from cabinet.staging import StagedUpload
 
 
 class FolderListFilter(admin.RelatedFieldListFilter):
@@ -34,13 +54,12 @@ class FolderListFilter(admin.RelatedFieldListFilter):
             if folder_id := self.used_parameters.get("folder__id__exact"):
                 if django.VERSION > (5,):
                     folder_id = folder_id[0]
+                try:
+                    folder = Folder.objects.only("path").get(pk=folder_id)
+                except (Folder.DoesNotExist, ValueError, ValidationError) as e:
+                    raise IncorrectLookupParameters(e) from e
                 return queryset.filter(
-                    # Avoid problems because of table aliasses (Django 1.11)
-                    folder__in=list(
-                        Folder.objects.descendants(
-                            folder_id, include_self=True
-                        ).values_list("id", flat=True)
-                    )
+                    folder__in=folder.descendants_including_self().values("id")
                 )
             return queryset
 
@@ -67,7 +86,7 @@ class FileTypeFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value():
-            return queryset.exclude(**{self.value(): ""})
+            return queryset.filter(kind=self.value())
         return queryset
 
 
@@ -96,6 +115,8 @@ class SelectFolderForm(forms.Form):
         files = kwargs.pop("files")
         super().__init__(*args, **kwargs)
 
+        if files is None:  # Files are selected using a selection token
+            return
         self.fields["files"] = forms.ModelMultipleChoiceField(
             queryset=files,
             label=capfirst(_("files")),
@@ -105,11 +126,150 @@ class SelectFolderForm(forms.Form):
         self.order_fields(["files", "folder"])
 
 
+# Number of selections kept in the session for moving files
+MAX_SELECTIONS = 10
+# Number of file names shown when confirming moving a selection
+SELECTION_SAMPLE_SIZE = 10
+
+AFTER_VAR = "after"
+BEFORE_VAR = "before"
+
+
+class CabinetChangeList(ChangeList):
+    """
+    Change list supporting keyset pagination
+
+    Keyset pagination is used when ``FileAdminBase.keyset_pagination`` is
+    enabled and the user isn't searching. Files are ordered by their name and
+    primary key; pages are identified by the primary key of the last file of
+    the previous page (``after``) or the first file of the next page
+    (``before``) instead of an offset. Fetching a page only reads the rows of
+    the page itself using the ``(folder, file_name, id)`` index, regardless
+    of how deep the page is.
+    """
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(AFTER_VAR, None)
+        params.pop(BEFORE_VAR, None)
+        return params
+
+    def get_ordering(self, request, queryset):
+        # Order search results by relevance
+        if self.query and "search_rank" in queryset.query.annotations:
+            return ["-search_rank", "file_name", "pk"]
+        return super().get_ordering(request, queryset)
+
+    def get_results(self, request):
+        # Keyset pagination only supports the default ordering
+        self.keyset_pagination = (
+            self.model_admin.keyset_pagination
+            and not self.query
+            and not self.show_all
+            and ORDER_VAR not in self.params
+        )
+        result_count, self.result_count_capped = self.model_admin.get_result_count(
+            request, self
+        )
+        if self.model_admin.show_full_result_count:
+            full_result_count = self.model_admin.get_full_result_count(request)
+        else:
+            full_result_count = None
+
+        if self.keyset_pagination:
+            self.result_list, self.multi_page = self._get_keyset_page(request)
+            self.can_show_all = False
+            self.paginator = None
+
+        else:
+            paginator = self.model_admin.get_paginator(
+                request, self.queryset, self.list_per_page
+            )
+            # The result count may be an estimate such as the folder's file
+            # counter. It is shown, but the listed rows never depend on it.
+            per_page = self.list_per_page
+            offset = (self.page_num - 1) * per_page
+            if offset < 0:
+                raise IncorrectLookupParameters
+            results = list(self.queryset[offset : offset + per_page + 1])
+            if offset and not results:
+                raise IncorrectLookupParameters
+            self.multi_page = bool(offset) or len(results) > per_page
+            self.can_show_all = (
+                self.multi_page
+                and self.queryset.order_by()[: self.list_max_show_all + 1].count()
+                <= self.list_max_show_all
+            )
+            if self.show_all and self.can_show_all:
+                self.result_list = self.queryset._clone()
+            else:
+                self.result_list = results[:per_page]
+            # Do not count again
+            paginator.count = max(result_count, offset + len(results))
+            self.paginator = paginator
+
+        self.model_admin.prefetch_results(request, self.result_list)
+        self.result_count = result_count
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.show_admin_actions = not self.show_full_result_count or bool(
+            full_result_count
+        )
+        self.full_result_count = full_result_count
+
+    def _get_keyset_page(self, request):
+        queryset = self.queryset.order_by("file_name", "pk")
+        per_page = self.list_per_page
+        if cursor := request.GET.get(AFTER_VAR) or request.GET.get(BEFORE_VAR):
+            try:
+                file_name = (
+                    self.model._base_manager.filter(pk=cursor)
+                    .values_list("file_name", flat=True)
+                    .get()
+                )
+            except (self.model.DoesNotExist, ValueError, ValidationError) as e:
+                raise IncorrectLookupParameters(e) from e
+
+        if request.GET.get(AFTER_VAR):
+            results = list(
+                queryset.filter(
+                    Q(file_name__gt=file_name) | Q(file_name=file_name, pk__gt=cursor)
+                )[: per_page + 1]
+            )
+            has_next, has_previous = len(results) > per_page, True
+            results = results[:per_page]
+        elif request.GET.get(BEFORE_VAR):
+            results = list(
+                queryset.filter(
+                    Q(file_name__lt=file_name) | Q(file_name=file_name, pk__lt=cursor)
+                ).reverse()[: per_page + 1]
+            )
+            has_next, has_previous = True, len(results) > per_page
+            results = results[:per_page][::-1]
+        else:
+            results = list(queryset[: per_page + 1])
+            has_next, has_previous = len(results) > per_page, False
+            results = results[:per_page]
+
+        remove = [AFTER_VAR, BEFORE_VAR, PAGE_VAR]
+        self.first_page_url = self.get_query_string(remove=remove)
+        self.previous_page_url = (
+            self.get_query_string({BEFORE_VAR: results[0].pk}, remove)
+            if has_previous and results
+            else None
+        )
+        self.next_page_url = (
+            self.get_query_string({AFTER_VAR: results[-1].pk}, remove)
+            if has_next and results
+            else None
+        )
+        return results, has_next or has_previous
+
+
 def cabinet_querystring(request, **kwargs):
     values = {
         key: value
         for key, value in request.GET.items()
-        if key not in {"folder__id__exact", "p"}
+        if key not in {"folder__id__exact", "p", "selection", AFTER_VAR, BEFORE_VAR}
     }
     values.update(kwargs)
     return urlencode(sorted(values.items()))
@@ -128,6 +288,11 @@ class FolderAdminMixin(admin.ModelAdmin):
                 self.admin_site.admin_view(self.folder_select),
                 name="cabinet_folder_select",
             ),
+            path(
+                "folder/<int:object_id>/download/",
+                self.admin_site.admin_view(self.folder_download),
+                name="cabinet_folder_download",
+            ),
             re_path(
                 r"^folder/(.+)/$",
                 self.admin_site.admin_view(self.folder_change),
@@ -147,6 +312,21 @@ class FolderAdminMixin(admin.ModelAdmin):
                 request, {"instance": get_object_or_404(Folder, pk=object_id)}
             )
 
+    def folder_download(self, request, object_id):
+        """
+        Stream a ZIP archive of the folder and all its descendants
+        """
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        folder = get_object_or_404(Folder, pk=object_id)
+        response = StreamingHttpResponse(
+            stream_zip(folder), content_type="application/zip"
+        )
+        response["Content-Disposition"] = "attachment; filename*=utf-8''{}".format(
+            quote(f"{folder.name}.zip")
+        )
+        return response
+
     def _folder_form(self, request, kw):
         original = kw.get("instance")
         add = not original
@@ -258,7 +438,16 @@ class FolderAdminMixin(admin.ModelAdmin):
         querydict = [
             (key, value)
             for key, value in request.GET.items()
-            if key not in {"files", "folder__id__exact", "p", "parent"}
+            if key
+            not in {
+                "files",
+                "folder__id__exact",
+                "p",
+                "parent",
+                "selection",
+                AFTER_VAR,
+                BEFORE_VAR,
+            }
         ]
         if folder_id:
             querydict.append(("folder__id__exact", folder_id))
@@ -268,30 +457,103 @@ class FolderAdminMixin(admin.ModelAdmin):
 
     @admin.action(description=_("Move files to folder"))
     def move_to_folder(self, request, queryset):
+        if request.POST.get("select_across") == "1":
+            # All files matching the changelist's filters, not only the
+            # files on the current page
+            selection = {"filters": request.GET.urlencode()}
+        else:
+            selection = {"pks": list(queryset.values_list("pk", flat=True))}
+
         return HttpResponseRedirect(
             "{}?{}".format(
                 reverse(
                     "admin:cabinet_folder_select", current_app=self.admin_site.name
                 ),
-                urlencode(sorted(("files", item.id) for item in queryset)),
+                urlencode({"selection": self._store_selection(request, selection)}),
             )
         )
 
-    def folder_select(self, request):
-        files = self.model.objects.filter(
-            pk__in=(request.POST.getlist("files") or request.GET.getlist("files"))
+    def _store_selection(self, request, selection):
+        """
+        Store the selection in the session and return a short token
+        referencing it
+        """
+        token = secrets.token_urlsafe(8)
+        selections = request.session.get("cabinet_selections", {})
+        # Only keep a few recent selections around
+        selections = dict(list(selections.items())[-(MAX_SELECTIONS - 1) :])
+        selections[token] = selection
+        request.session["cabinet_selections"] = selections
+        return token
+
+    def _selected_files(self, request, token):
+        selection = request.session.get("cabinet_selections", {}).get(token)
+        if selection is None:
+            return None
+        if "pks" in selection:
+            return self.model._default_manager.filter(pk__in=selection["pks"])
+
+        # Recreate the changelist the files have been selected in
+        changelist_request = copy.copy(request)
+        changelist_request.GET = QueryDict(selection["filters"])
+        changelist = self.get_changelist_instance(changelist_request)
+        return self.model._default_manager.filter(
+            pk__in=changelist.get_queryset(changelist_request).values("pk")
         )
 
+    def folder_select(self, request):
+        token = request.GET.get("selection")
+        if token:
+            files = self._selected_files(request, token)
+            if files is None:
+                self.message_user(
+                    request, _("The selection has expired."), messages.ERROR
+                )
+                return self.redirect_to_folder(request, None)
+        else:
+            files = self.model.objects.filter(
+                pk__in=(request.POST.getlist("files") or request.GET.getlist("files"))
+            )
+
         form = SelectFolderForm(
-            request.POST if request.method == "POST" else None, files=files
+            request.POST if request.method == "POST" else None,
+            files=None if token else files,
         )
 
         if form.is_valid():
             folder = form.cleaned_data["folder"]
-            form.cleaned_data["files"].update(folder=folder)
+            if not token:
+                files = form.cleaned_data["files"]
+            files = files.exclude(folder=folder)
+            with transaction.atomic(using=router.db_for_write(self.model)):
+                for old_folder, num_files, size in (
+                    files.order_by()
+                    .values("folder")
+                    .annotate(Count("id"), Sum("file_size"))
+                    .values_list("folder", "id__count", "file_size__sum")
+                ):
+                    self.model.update_folder_counters(old_folder, -num_files, -size)
+                    self.model.update_folder_counters(folder.pk, num_files, size)
+                files.update(folder=folder)
+            if token:
+                request.session["cabinet_selections"].pop(token, None)
+                request.session.modified = True
             self.message_user(request, _("The files have been successfully moved."))
             return self.redirect_to_folder(request, folder.id)
 
+        cabinet_context = {"querystring": cabinet_querystring(request)}
+        if token:
+            summary = files.aggregate(count=Count("id"), size=Sum("file_size"))
+            cabinet_context["selection"] = {
+                **summary,
+                "names": list(
+                    files.order_by("file_name").values_list("file_name", flat=True)[
+                        :SELECTION_SAMPLE_SIZE
+                    ]
+                ),
+                "more": summary["count"] > SELECTION_SAMPLE_SIZE,
+            }
+
         admin_form = helpers.AdminForm(
             form,
             [[None, {"fields": list(form.fields.keys())}]],
@@ -313,7 +575,7 @@ class FolderAdminMixin(admin.ModelAdmin):
                 media=self.media + admin_form.media,
                 errors=helpers.AdminErrorList(form, []),
                 preserve_filters=self.get_preserved_filters(request),
-                cabinet={"querystring": cabinet_querystring(request)},
+                cabinet=cabinet_context,
             ),
             add=False,
             change=False,
@@ -350,11 +612,27 @@ class UploadForm(forms.Form):
     file = forms.FileField()
 
 
+class BatchUploadForm(forms.Form):
+    folder = forms.ModelChoiceField(queryset=Folder.objects.all())
+
+
+class ChunkedUploadForm(forms.Form):
+    folder = forms.ModelChoiceField(queryset=Folder.objects.all())
+    name = forms.CharField(max_length=1000)
+    size = forms.IntegerField(min_value=1)
+
+
 class FileAdminBase(FolderAdminMixin):
     actions = ["move_to_folder"]
     form = IgnoreChangedDataErrorsForm
     list_filter = [("folder", FolderListFilter), FileTypeFilter]
     search_fields = ("file_name",)
+    # Use keyset instead of offset pagination (see CabinetChangeList)
+    keyset_pagination = False
+    # Stop counting search results after this many files
+    search_result_count_limit = 10000
+    # Seconds the total number of files is cached (when not estimated)
+    full_result_count_timeout = 300
 
     # Useful when swapping the file model
     change_form_template = "admin/cabinet/file/change_form.html"
@@ -370,39 +648,101 @@ class FileAdminBase(FolderAdminMixin):
                 "upload/",
                 self.admin_site.admin_view(self.upload),
                 name="cabinet_upload",
-            )
+            ),
+            path(
+                "upload/check/",
+                self.admin_site.admin_view(self.upload_check),
+                name="cabinet_upload_check",
+            ),
+            path(
+                "upload/batch/",
+                self.admin_site.admin_view(self.upload_batch),
+                name="cabinet_upload_batch",
+            ),
+            path(
+                "upload/chunked/",
+                self.admin_site.admin_view(self.upload_chunked),
+                name="cabinet_upload_chunked",
+            ),
+            path(
+                "upload/chunked/<str:upload_id>/",
+                self.admin_site.admin_view(self.upload_chunk),
+                name="cabinet_upload_chunk",
+            ),
+            path(
+                "upload/chunked/<str:upload_id>/finalize/",
+                self.admin_site.admin_view(self.upload_finalize),
+                name="cabinet_upload_finalize",
+            ),
         ] + super().get_urls()
 
-    def folders_annotate_counts(self, folders):
+    def get_changelist(self, request, **kwargs):
+        return CabinetChangeList
+
+    def prefetch_results(self, request, results):
+        """
+        Load data needed to render a page of files in bulk; by default the
+        state of the admin thumbnails
         """
-        Add direct subfolders and files counts to an iterable of folders
+        if hasattr(self.model, "image_file"):
+            prefetch_renditions(results, ADMIN_THUMBNAIL)
 
-        Recursive traversal and summation isn't implemented as adjacency
-        list-based tree traversal without common table expressions is
-        expensive. We want to stay compatible even with stupid database
-        engines!
+    def get_search_results(self, request, queryset, search_term):
         """
-        num_subfolders = dict(
-            Folder.objects.order_by()
-            .filter(parent__in=folders)
-            .values("parent")
-            .annotate(Count("id"))
-            .values_list("parent", "id__count")
-        )
+        Search files using the configured ``CABINET_SEARCH_BACKEND``
+        """
+        if not search_term:
+            return queryset, False
+        return get_search_backend().search(queryset, search_term), False
 
-        num_files = dict(
-            self.model._default_manager.order_by()
-            .filter(folder__in=folders)
-            .values("folder")
-            .annotate(Count("id"))
-            .values_list("folder", "id__count")
-        )
+    def get_result_count(self, request, changelist):
+        """
+        Return the number of files in the changelist and whether the number
+        is a lower bound only
+
+        Listing a folder uses its denormalized file counter. Searches stop
+        counting after ``search_result_count_limit`` files. Override this
+        method if ``get_queryset`` hides files.
+        """
+        if changelist.query:
+            limit = self.search_result_count_limit
+            count = changelist.queryset.order_by()[: limit + 1].count()
+            return min(count, limit), count > limit
+
+        if set(changelist.get_filters_params()) == {"folder__id__exact"}:
+            num_files = (
+                Folder.objects.filter(pk=request.GET["folder__id__exact"])
+                .values_list("num_files", flat=True)
+                .first()
+            )
+            if num_files is not None:
+                return num_files, False
 
-        for f in folders:
-            f.num_subfolders = num_subfolders.get(f.id, 0)
-            f.num_files = num_files.get(f.id, 0)
+        return changelist.queryset.count(), False
 
-        return folders
+    def get_full_result_count(self, request):
+        """
+        Return the total number of files
+
+        Uses the query planner's estimate on PostgreSQL; exact counts are
+        cached for ``full_result_count_timeout`` seconds.
+        """
+        connection = connections[router.db_for_read(self.model)]
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [connection.ops.quote_name(self.model._meta.db_table)],
+                )
+                row = cursor.fetchone()
+            if row and row[0] > 0:
+                return row[0]
+
+        return cache.get_or_set(
+            f"cabinet-full-result-count-{self.model._meta.label_lower}",
+            lambda: self.get_queryset(request).count(),
+            self.full_result_count_timeout,
+        )
 
     def changelist_view(self, request, extra_context=None):
         folder__id__exact = request.GET.get("folder__id__exact")
@@ -415,7 +755,9 @@ class FileAdminBase(FolderAdminMixin):
         cabinet_context = {
             # Keep query params except those in the set below when changing
             # folders
-            "querystring": cabinet_querystring(request)
+            "querystring": cabinet_querystring(request),
+            # Clients only check for existing files when they can be shared
+            "deduplicate": getattr(settings, "CABINET_DEDUPLICATE_FILES", False),
         }
 
         folder = None
@@ -431,9 +773,7 @@ class FileAdminBase(FolderAdminMixin):
             cabinet_context.update(
                 {
                     "folder": folder,
-                    "folder_children": self.folders_annotate_counts(
-                        Folder.objects.filter(parent=folder)
-                    ),
+                    "folder_children": Folder.objects.filter(parent=folder),
                 }
             )
 
@@ -494,6 +834,191 @@ class FileAdminBase(FolderAdminMixin):
 
         return JsonResponse({"success": True, "pk": f.pk, "name": str(f)})
 
+    def upload_check(self, request):
+        """
+        Add files which exist already without uploading them again
+
+        Expects a JSON body of the form ``{"folder": <pk>, "files": [{"hash":
+        <hex SHA-256>, "size": <bytes>, "name": <file name>}, ...]}``. When
+        using ``CABINET_DEDUPLICATE_FILES``, a file referencing the existing
+        blob and named like the local file is added to the folder for each
+        known hash. The response tells the client
+        which files still have to be uploaded.
+        """
+        if request.method != "POST":
+            return self.redirect_to_folder(request, None)
+        try:
+            data = json.loads(request.body)
+            folder = Folder.objects.get(pk=data["folder"])
+            files = [
+                (str(row["hash"]), int(row["size"]), os.path.basename(row["name"]))
+                for row in data["files"]
+            ]
+        except (Folder.DoesNotExist, KeyError, TypeError, ValueError):
+            return JsonResponse({"success": False}, status=400)
+
+        results = []
+        with transaction.atomic(using=router.db_for_write(self.model)):
+            existing = {}
+            if getattr(settings, "CABINET_DEDUPLICATE_FILES", False):
+                # Lock the files so that their blobs aren't deleted meanwhile
+                for f in self.model._base_manager.filter(
+                    file_hash__in={digest for digest, size, name in files}
+                ).select_for_update():
+                    existing.setdefault((f.file_hash, f.file_size), f)
+
+            for digest, size, name in files:
+                if original := existing.get((digest, size)):
+                    f = self.model(folder=folder, file_name=name)
+                    f.share_file(original)
+                    f.save()
+                    results.append(
+                        {"hash": digest, "exists": True, "pk": f.pk, "name": str(f)}
+                    )
+                else:
+                    results.append({"hash": digest, "exists": False})
+
+        return JsonResponse({"success": True, "files": results})
+
+    def upload_batch(self, request):
+        """
+        Upload many files (the ``files`` field) at once
+
+        All files are inserted using one ``bulk_create()`` call inside a
+        single transaction, which means that no ``pre_save`` and ``post_save``
+        signals are sent; the search index, the folder counters and the
+        renditions are updated here instead. The blobs are removed again if
+        the transaction fails. The response contains one result per file;
+        ``pk`` is ``null`` on databases which cannot return primary keys from
+        bulk inserts (e.g. MySQL).
+        """
+        if request.method != "POST":
+            return self.redirect_to_folder(request, None)
+        form = BatchUploadForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({"success": False}, status=400)
+
+        field = forms.FileField()
+        files, results = [], []
+        for upload in request.FILES.getlist("files"):
+            try:
+                field.clean(upload)
+            except ValidationError as exc:
+                results.append(
+                    {"success": False, "name": upload.name, "errors": exc.messages}
+                )
+                continue
+
+            f = self.model(folder=form.cleaned_data["folder"])
+            f.file = upload
+            files.append(f)
+            results.append(f)
+
+        using = router.db_for_write(self.model)
+        try:
+            with transaction.atomic(using=using):
+                # Inside the transaction because deduplication locks files
+                for f in files:
+                    f.prepare_save()
+                self.model._default_manager.bulk_create(files)
+                get_search_backend().index(files)
+                schedule_renditions(files)
+                self.model.update_folder_counters(
+                    form.cleaned_data["folder"].pk,
+                    len(files),
+                    sum(f.file_size for f in files),
+                )
+        except Exception:
+            # The file fields have stored the blobs already. Blobs of
+            # deduplicated files are referenced by other files and are kept.
+            delete_blobs(
+                unreferenced_files(
+                    [f.file for f in files if f.file._committed], using=using
+                )
+            )
+            raise
+
+        return JsonResponse(
+            {
+                "success": bool(files),
+                "files": [
+                    {"success": True, "pk": f.pk, "name": str(f)}
+                    if isinstance(f, self.model)
+                    else f
+                    for f in results
+                ],
+            }
+        )
+
+    def upload_chunked(self, request):
+        """
+        Start a resumable upload
+
+        The client then sends the chunks to ``upload/chunked/<id>/`` using
+        ``PUT`` requests with the position of the chunk in the ``offset``
+        query parameter, and posts to ``upload/chunked/<id>/finalize/`` when
+        all chunks have been sent. ``GET`` returns the offset where the upload has to be
+        resumed, ``DELETE`` cancels the upload.
+        """
+        if request.method != "POST":
+            return self.redirect_to_folder(request, None)
+        form = ChunkedUploadForm(request.POST)
+        if not form.is_valid():
+            return JsonResponse({"success": False}, status=400)
+
+        upload = StagedUpload.create(
+            folder_id=form.cleaned_data["folder"].pk,
+            name=form.cleaned_data["name"],
+            size=form.cleaned_data["size"],
+        )
+        return JsonResponse({"success": True, "upload": upload.id, "offset": 0})
+
+    def upload_chunk(self, request, upload_id):
+        try:
+            upload = StagedUpload(upload_id)
+        except LookupError:
+            return JsonResponse({"success": False}, status=404)
+
+        if request.method == "DELETE":
+            upload.delete()
+            return JsonResponse({"success": True})
+
+        elif request.method == "PUT":
+            try:
+                offset = int(request.GET["offset"])
+            except (KeyError, ValueError):
+                return JsonResponse({"success": False}, status=400)
+            # Streams the request body to the staging area; request.body
+            # would load the whole chunk into memory.
+            if not upload.append(offset, request):
+                return JsonResponse(
+                    {"success": False, "offset": upload.offset}, status=409
+                )
+
+        return JsonResponse({"success": True, "offset": upload.offset})
+
+    def upload_finalize(self, request, upload_id):
+        if request.method != "POST":
+            return self.redirect_to_folder(request, None)
+        try:
+            upload = StagedUpload(upload_id)
+        except LookupError:
+            return JsonResponse({"success": False}, status=404)
+        if not upload.complete:
+            return JsonResponse({"success": False, "offset": upload.offset}, status=409)
+        folder = Folder.objects.filter(pk=upload.meta["folder"]).first()
+        if not folder:
+            upload.delete()
+            return JsonResponse({"success": False}, status=400)
+
+        with upload.open() as file:
+            f = self.model(folder=folder)
+            f.file = file
+            f.save()
+        upload.delete()
+
+        return JsonResponse({"success": True, "pk": f.pk, "name": str(f)})
+
     top_fields = ["folder", "caption", "copyright"]
     advanced_fields = ["_overwrite"]
 
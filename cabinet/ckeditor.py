@@ -1,15 +1,16 @@
 import django
 from django import forms
 from django.contrib import admin
-from django.contrib.admin.views.main import ChangeList
 from django.utils.html import format_html
 
+from cabinet.base_admin import CabinetChangeList
+
 
 class CKEditorFilebrowserMixin(admin.ModelAdmin):
     def get_changelist(self, request, **kwargs):
         if request.GET.get("CKEditorFuncNum"):
             return CKFileBrowserChangeList
-        return ChangeList
+        return super().get_changelist(request, **kwargs)
 
     @property
     def media(self):
@@ -22,7 +23,7 @@ def _extract(value):
     return value[0] if value and django.VERSION > (5,) else value
 
 
-class CKFileBrowserChangeList(ChangeList):
+class CKFileBrowserChangeList(CabinetChangeList):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.list_display = [
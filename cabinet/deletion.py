@@ -0,0 +1,206 @@
+"""
+Delete the blobs of deleted files in batches
+
+Deleting files one by one means one or more storage calls per file inside
+the request. Instead, the blobs of deleted files are collected and deleted
+together after the transaction has been committed, using the storage's
+``delete_many(names)`` method if it has one or a pool of
+``CABINET_DELETION_WORKERS`` (defaults to 8) threads otherwise. Blobs of files
+deleted in transactions which are rolled back are kept. Failures are logged;
+the database rows stay deleted.
+
+With ``CABINET_DELETION_QUEUE = True``, deletions are recorded as
+``PendingDeletion`` rows inside the transaction instead and are processed by
+``./manage.py process_cabinet_deletions``, which retries failed deletions with
+an exponential backoff. Blobs are therefore never deleted when the
+transaction is rolled back.
+"""
+
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+
+from cabinet.renditions import forget_renditions
+
+
+logger = logging.getLogger(__name__)
+
+
+def schedule_deletion(files, *, using=None):
+    """
+    Delete the blobs of field files when the transaction commits
+
+    Blobs which are still referenced by files at that time are kept.
+    """
+    # Copies, the field files of instances may change until the commit
+    files = [
+        f_obj.field.attr_class(None, f_obj.field, f_obj.name)
+        for f_obj in files
+        if f_obj.name
+    ]
+    if not files:
+        return
+
+    using = using or router.db_for_write(files[0].field.model)
+    if deletion_queue_enabled():
+        enqueue(files, using=using)
+        return
+
+    # Every call registers a callback, but the first one deletes the blobs of
+    # all files scheduled until then. Files scheduled in transactions which
+    # have been rolled back are still referenced and are therefore kept.
+    connection = transaction.get_connection(using)
+    if not hasattr(connection, "_cabinet_deletions"):
+        connection._cabinet_deletions = []
+    connection._cabinet_deletions.extend(files)
+    transaction.on_commit(lambda: _flush(connection), using=using)
+
+
+def _flush(connection):
+    files, connection._cabinet_deletions = connection._cabinet_deletions, []
+    if files:
+        delete_blobs(unreferenced_files(files, using=connection.alias))
+
+
+def deletion_queue_enabled():
+    return getattr(settings, "CABINET_DELETION_QUEUE", False)
+
+
+def enqueue(files, *, using=None):
+    """
+    Record the deletion of field files in the current transaction
+    """
+    PendingDeletion = apps.get_model("cabinet", "PendingDeletion")
+    PendingDeletion.objects.using(
+        using or router.db_for_write(PendingDeletion)
+    ).bulk_create(
+        PendingDeletion(
+            field=f"{f_obj.field.model._meta.label}.{f_obj.field.name}",
+            name=f_obj.name,
+        )
+        for f_obj in files
+    )
+
+
+def process_pending_deletions(*, batch_size=100, max_attempts=10):
+    """
+    Delete a batch of due blobs from the deletion queue and return the number
+    of deleted and failed entries
+
+    Entries are locked while processing them if the database supports it so
+    that several workers may run at the same time. Failed deletions are
+    retried after one minute, two minutes, four minutes etc. (at most once a
+    day) until ``max_attempts`` have been made.
+    """
+    PendingDeletion = apps.get_model("cabinet", "PendingDeletion")
+    using = router.db_for_write(PendingDeletion)
+    connection = transaction.get_connection(using)
+    with transaction.atomic(using=using):
+        queryset = PendingDeletion.objects.using(using).filter(
+            next_attempt_at__lte=timezone.now(), attempts__lt=max_attempts
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        entries = list(queryset[:batch_size])
+        if not entries:
+            return 0, 0
+
+        files = [entry.field_file() for entry in entries]
+        failed = delete_blobs(unreferenced_files(files, using=using))
+
+        now = timezone.now()
+        retry = [entry for entry in entries if entry.name in failed]
+        for entry in retry:
+            entry.attempts += 1
+            entry.next_attempt_at = now + timedelta(
+                minutes=min(2 ** (entry.attempts - 1), 24 * 60)
+            )
+            entry.last_error = repr(failed[entry.name])
+        PendingDeletion.objects.using(using).bulk_update(
+            retry, ["attempts", "next_attempt_at", "last_error"]
+        )
+        PendingDeletion.objects.using(using).filter(
+            pk__in=[entry.pk for entry in entries if entry.name not in failed]
+        ).delete()
+
+    return len(entries) - len(retry), len(retry)
+
+
+def unreferenced_files(files, *, using=None):
+    """
+    Return those field files whose name isn't referenced by any file in the
+    database (anymore)
+    """
+    names = defaultdict(set)
+    for f_obj in files:
+        names[f_obj.field.model, f_obj.field.name].add(f_obj.name)
+
+    referenced = set()
+    for (model, field), field_names in names.items():
+        batch = sorted(field_names)
+        for i in range(0, len(batch), 500):
+            referenced.update(
+                (model, field, name)
+                for name in model._base_manager.using(using)
+                .filter(**{f"{field}__in": batch[i : i + 500]})
+                .values_list(field, flat=True)
+            )
+
+    return [
+        f_obj
+        for f_obj in files
+        if (f_obj.field.model, f_obj.field.name, f_obj.name) not in referenced
+    ]
+
+
+def delete_blobs(files):
+    """
+    Delete the blobs of field files and their generated files (e.g.
+    thumbnails), and return a dictionary of names of blobs which could not
+    be deleted and the exceptions
+    """
+    by_storage = defaultdict(list)
+    for f_obj in files:
+        by_storage[f_obj.storage].append(f_obj)
+
+    failed = {}
+    workers = max(1, getattr(settings, "CABINET_DELETION_WORKERS", 8))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for storage, storage_files in by_storage.items():
+            bulk = hasattr(storage, "delete_many")
+            if bulk:
+                names = [f_obj.name for f_obj in storage_files]
+                try:
+                    storage.delete_many(names)
+                except Exception as exc:
+                    logger.exception("Deleting %s blobs failed", len(names))
+                    failed.update(dict.fromkeys(names, exc))
+            futures.extend(
+                (f_obj.name, executor.submit(_delete, f_obj, blob=not bulk))
+                for f_obj in storage_files
+            )
+
+        for name, future in futures:
+            try:
+                future.result()
+            except Exception as exc:
+                logger.exception("Deleting %s failed", name)
+                failed[name] = exc
+
+    return failed
+
+
+def _delete(f_obj, *, blob):
+    if blob:
+        f_obj.storage.delete(f_obj.name)
+    # django-imagefield's processed images
+    if hasattr(f_obj.field, "_clear_generated_files_for"):
+        f_obj.field._clear_generated_files_for(f_obj, f_obj.name)
+        forget_renditions(f_obj)
@@ -1,15 +1,44 @@
-import random
-import string
+import shutil
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from zipfile import ZIP_DEFLATED, ZipFile
+from tempfile import SpooledTemporaryFile
+from zipfile import ZIP_DEFLATED, BadZipFile, ZipFile
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
+from cabinet.archive import CHUNK_SIZE, arc_path, walk, zip_info
 from cabinet.models import Folder
 
 
-def _get_random_suffix():
-    return random.choices(string.ascii_lowercase, k=4)
+# Prefetched files larger than this are buffered on disk
+READ_AHEAD_MEMORY = 8 * 1024 * 1024
+
+
+def parse_size(value):
+    """
+    Parse sizes such as ``"500"`` (bytes), ``"100K"``, ``"650M"`` or ``"4G"``
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    value = value.strip().upper()
+    factor = units.get(value[-1:], 1)
+    try:
+        size = int(value[:-1] if factor > 1 else value) * factor
+    except ValueError as exc:
+        raise CommandError(f"Invalid size {value!r}") from exc
+    if size <= 0:
+        raise CommandError(f"Invalid size {value!r}")
+    return size
+
+
+def _read(f_obj):
+    # Closed by the caller
+    buffer = SpooledTemporaryFile(max_size=READ_AHEAD_MEMORY)  # noqa: SIM115
+    with f_obj.storage.open(f_obj.name, "rb") as source:
+        shutil.copyfileobj(source, buffer, CHUNK_SIZE)
+    buffer.seek(0)
+    return buffer
 
 
 class Command(BaseCommand):
@@ -17,35 +46,167 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument("--folder-id", type=int, required=True)
-        parser.add_argument("--output", type=Path, required=True)
+        parser.add_argument(
+            "--output",
+            required=True,
+            help='Path of the archive, or "-" to write the archive to stdout.',
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Read this many files from the storage at the same time.",
+        )
+        parser.add_argument(
+            "--volume-size",
+            type=parse_size,
+            help=(
+                "Split the archive into volumes of about this size (e.g. 4G),"
+                " named archive.001.zip, archive.002.zip etc. Each volume is a"
+                " complete ZIP archive."
+            ),
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help=(
+                "Skip files contained in existing volumes or in the existing"
+                " archive. Incomplete volumes are written again."
+            ),
+        )
 
     def handle(self, **options):
         folder = Folder.objects.get(id=options["folder_id"])
-        output = options["output"]
-
-        arc_paths = set()
-        with ZipFile(output, "w", ZIP_DEFLATED) as zip_file:
-            for file, path in self._walk(folder, path=()):
-                arc_path = Path(*path) / file.file_name
-
-                if arc_path in arc_paths:
-                    filename = Path(file.file_name)
-                    arc_path = Path(*path) / "".join(
-                        [
-                            filename.stem,
-                            "_",
-                            *_get_random_suffix(),
-                            *filename.suffixes,
-                        ]
-                    )
-
-                zip_file.write(file.file.path, arc_path)
-                arc_paths.add(arc_path)
-
-    def _walk(self, folder, *, path):
-        path = (*tuple(path), folder.name)
-        for file_ in folder.files.all():
-            yield (file_, path)
-
-        for child in folder.children.all():
-            yield from self._walk(child, path=path)
+        self.verbosity = options["verbosity"]
+        self.volume_size = options["volume_size"]
+        if options["output"] == "-":
+            if self.volume_size or options["resume"]:
+                raise CommandError("--volume-size and --resume require a path.")
+            self.output = self.stdout.buffer
+        else:
+            self.output = Path(options["output"])
+
+        self.zip_file = None
+        self.volume = 0
+        self.mode = "w"
+        self.resumed_size = 0
+        done, arc_paths = self._resume() if options["resume"] else (set(), set())
+
+        self.progress_total = (
+            folder.num_files_recursive - len(done),
+            folder.size_recursive - self.resumed_size,
+        )
+        self.progress = [0, 0]
+        self.started = self.reported = time.monotonic()
+
+        # Files are identified by their primary key, several files may share
+        # a blob when using deduplication
+        entries = (entry for entry in walk(folder) if entry[5] not in done)
+        try:
+            for entry, content in self._prefetch(entries, options["workers"]):
+                f_obj, file_name, size, updated_at, path, pk = entry
+                info = zip_info(
+                    f_obj, arc_path(arc_paths, path, file_name), size, updated_at, pk
+                )
+                with content:
+                    self._write(info, content)
+                self._report(1, size or 0)
+
+        finally:
+            if self.zip_file:
+                self.zip_file.close()
+        self._report(0, 0, final=True)
+
+    def _volume_path(self, volume):
+        if not self.volume_size:
+            return self.output
+        return self.output.with_name(
+            f"{self.output.stem}.{volume:03d}{self.output.suffix}"
+        )
+
+    def _resume(self):
+        """
+        Return the primary keys and archive paths of all files in complete
+        volumes and prepare writing the next volume
+        """
+        done, arc_paths = set(), set()
+        while True:
+            path = self._volume_path(self.volume + 1)
+            try:
+                with ZipFile(path) as zip_file:
+                    for info in zip_file.infolist():
+                        done.add(int(info.comment.split(b":", 1)[0]))
+                        arc_paths.add(Path(info.filename))
+                        self.resumed_size += info.file_size
+            except (FileNotFoundError, BadZipFile):
+                break
+            if not self.volume_size:
+                # Append to the existing archive
+                self.mode = "a"
+                break
+            self.volume += 1
+        return done, arc_paths
+
+    def _prefetch(self, entries, workers):
+        """
+        Yield entries together with a file object containing their content
+
+        With more than one worker, up to ``2 * workers`` files are read ahead
+        while the current file is compressed and written.
+        """
+        if workers <= 1:
+            for entry in entries:
+                yield entry, entry[0].storage.open(entry[0].name, "rb")
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for entry in entries:
+                pending.append((entry, executor.submit(_read, entry[0])))
+                if len(pending) >= 2 * workers:
+                    ready, future = pending.popleft()
+                    yield ready, future.result()
+            while pending:
+                ready, future = pending.popleft()
+                yield ready, future.result()
+
+    def _write(self, info, content):
+        if self.zip_file is None or (
+            self.volume_size
+            and self.volume_bytes
+            and self.volume_bytes + info.file_size > self.volume_size
+        ):
+            if self.zip_file:
+                self.zip_file.close()
+            self.volume += 1
+            self.zip_file = ZipFile(
+                self._volume_path(self.volume), self.mode, ZIP_DEFLATED
+            )
+            self.volume_bytes = 0
+
+        with self.zip_file.open(info, "w") as target:
+            shutil.copyfileobj(content, target, CHUNK_SIZE)
+        self.volume_bytes += info.compress_size
+
+    def _report(self, files, size, *, final=False):
+        self.progress[0] += files
+        self.progress[1] += size
+        now = time.monotonic()
+        if self.verbosity < 1 or not (final or now - self.reported >= 1):
+            return
+
+        self.reported = now
+        count, written = self.progress
+        rate = written / max(now - self.started, 0.001) / 1024**2
+        if final:
+            self.stderr.write(
+                f"Archived {count} files ({written / 1024**2:.1f} MiB,"
+                f" {rate:.1f} MiB/s) into {max(self.volume, 1)} volume(s)."
+            )
+        else:
+            total_count, total_size = self.progress_total
+            self.stderr.write(
+                f"{count}/{total_count} files,"
+                f" {written / 1024**2:.1f}/{total_size / 1024**2:.1f} MiB,"
+                f" {rate:.1f} MiB/s"
+            )
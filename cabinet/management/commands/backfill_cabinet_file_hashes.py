@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management import BaseCommand
+from django.db.models import Q
+
+from cabinet.base import content_hash
+from cabinet.models import get_file_model
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill in the content hash of files uploaded before it has been"
+        " recorded so that deduplication finds them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of threads reading blobs from the storage.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, **options):
+        self.model = get_file_model()
+        has_file = Q()
+        for field in self.model.FILE_FIELDS:
+            has_file |= ~Q(**{field: ""})
+        queryset = self.model._base_manager.filter(has_file, file_hash="").order_by(
+            "pk"
+        )
+
+        updated = failed = 0
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while files := list(
+                queryset.filter(pk__gt=last_pk)[: options["batch_size"]]
+            ):
+                last_pk = files[-1].pk
+                for file, digest in zip(files, executor.map(self._hash, files)):
+                    if not digest:
+                        failed += 1
+                        continue
+                    # Only update files which haven't been changed meanwhile
+                    updated += self.model._base_manager.filter(
+                        pk=file.pk,
+                        file_hash="",
+                        **{file.file.field.name: file.file.name},
+                    ).update(file_hash=digest)
+
+        self.stdout.write(
+            f"Updated the hash of {updated} files, {failed} blobs could not be read."
+        )
+
+    def _hash(self, file):
+        """
+        Return the content hash of a file's blob, runs in the worker threads
+        """
+        f_obj = file.file
+        try:
+            with f_obj.storage.open(f_obj.name, "rb") as blob:
+                return content_hash(blob)
+        except OSError as exc:
+            self.stderr.write(f"{f_obj.name}: {exc!r}")
+            return None
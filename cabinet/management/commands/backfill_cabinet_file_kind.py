@@ -0,0 +1,32 @@
+from django.core.management import BaseCommand
+from django.db.models import Max
+
+from cabinet.models import get_file_model
+
+
+class Command(BaseCommand):
+    help = "Fill in the kind of all files, e.g. after adding file fields."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="Update the files in primary key ranges of this size.",
+        )
+
+    def handle(self, **options):
+        model = get_file_model()
+        batch_size = options["batch_size"]
+        last = model._base_manager.aggregate(Max("pk"))["pk__max"] or 0
+
+        updated = 0
+        for start in range(0, last + 1, batch_size):
+            files = model._base_manager.filter(pk__gte=start, pk__lt=start + batch_size)
+            # The first filled in file field wins, like in AbstractFile.file
+            for field in reversed(model.FILE_FIELDS):
+                updated += (
+                    files.exclude(**{field: ""}).exclude(kind=field).update(kind=field)
+                )
+
+        self.stdout.write(f"Updated the kind of {updated} files.")
@@ -0,0 +1,160 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management import BaseCommand
+from django.db import router, transaction
+from django.db.models import Q
+from PIL import Image
+
+from cabinet.base import MAGIC_BYTES_LENGTH
+from cabinet.models import get_file_model
+
+
+#: Fields derived from the blob which are checked if the file model has them
+CHECKED_FIELDS = ["file_size", "image_width", "image_height", "download_type"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that the blobs of all files exist and that their size, image"
+        " dimensions and download type are up to date. Problems are written"
+        " to stdout as JSON lines."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=16,
+            help="Number of threads talking to the storage.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Update outdated fields (missing blobs cannot be fixed).",
+        )
+
+    def handle(self, **options):
+        self.model = get_file_model()
+        self.fields = []
+        for field in CHECKED_FIELDS:
+            try:
+                self.model._meta.get_field(field)
+            except FieldDoesNotExist:
+                continue
+            self.fields.append(field)
+
+        queryset = self.model._base_manager.order_by("pk").values(
+            "pk", "folder", *self.model.FILE_FIELDS, *self.fields
+        )
+        checked = problems = fixed = 0
+        last_pk = 0
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while rows := list(
+                queryset.filter(pk__gt=last_pk)[: options["batch_size"]]
+            ):
+                last_pk = rows[-1]["pk"]
+                checked += len(rows)
+                results = [
+                    result
+                    for result in executor.map(self._check, rows)
+                    if result is not None
+                ]
+                for result in results:
+                    self.stdout.write(json.dumps(result))
+                problems += len(results)
+                if options["fix"]:
+                    fixed += self._fix(
+                        [result for result in results if result["changes"]],
+                        {row["pk"]: row for row in rows},
+                    )
+
+        self.stderr.write(
+            f"Checked {checked} files, found {problems} problems, fixed {fixed}."
+        )
+
+    def _check(self, row):
+        """
+        Compare a file with its blob, runs in the worker threads
+        """
+        for field in self.model.FILE_FIELDS:
+            if row[field]:
+                name = row[field]
+                break
+        else:
+            return {"pk": row["pk"], "name": "", "error": "no file", "changes": {}}
+
+        result = {"pk": row["pk"], "name": name, "error": "", "changes": {}}
+        storage = self.model._meta.get_field(field).storage
+        try:
+            if not storage.exists(name):
+                result["error"] = "missing"
+                return result
+            actual = {"file_size": storage.size(name)}
+            if field == "image_file":
+                with storage.open(name, "rb") as file:
+                    # Only reads the header
+                    actual["image_width"], actual["image_height"] = Image.open(
+                        file
+                    ).size
+            elif field == "download_file":
+                classifier = self.model.download_type_classifier()
+                if not (download_type := classifier.by_name(name)):
+                    with storage.open(name, "rb") as file:
+                        head = file.read(MAGIC_BYTES_LENGTH)
+                    download_type = classifier.by_content(head) or classifier.fallback
+                actual["download_type"] = download_type
+        except Exception as exc:
+            result["error"] = repr(exc)
+            return result
+
+        result["changes"] = {
+            field: [row[field], value]
+            for field, value in actual.items()
+            if field in self.fields and row[field] != value
+        }
+        return result if result["changes"] else None
+
+    def _fix(self, results, rows):
+        if not results:
+            return 0
+        using = router.db_for_write(self.model)
+        with transaction.atomic(using=using):
+            # Only fix files which haven't been changed since being checked
+            unchanged = Q()
+            for result in results:
+                row = rows[result["pk"]]
+                values = {
+                    field: row[field] for field in ["folder", *self.model.FILE_FIELDS]
+                }
+                for field, (old, _new) in result["changes"].items():
+                    values[field] = old
+                unchanged |= Q(pk=row["pk"], **values)
+            locked = set(
+                self.model._base_manager.using(using)
+                .filter(unchanged)
+                .select_for_update()
+                .values_list("pk", flat=True)
+            )
+            results = [result for result in results if result["pk"] in locked]
+
+            # Group the files by the changed fields so that no other fields
+            # are overwritten
+            groups = {}
+            for result in results:
+                instance = self.model(pk=result["pk"])
+                for field, (_old, new) in result["changes"].items():
+                    setattr(instance, field, new)
+                groups.setdefault(tuple(sorted(result["changes"])), []).append(instance)
+            for fields, instances in groups.items():
+                self.model._base_manager.using(using).bulk_update(instances, fields)
+
+            for result in results:
+                if size := result["changes"].get("file_size"):
+                    self.model.update_folder_counters(
+                        rows[result["pk"]]["folder"], 0, size[1] - size[0]
+                    )
+
+        return len(results)
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.core.management import BaseCommand
+
+from cabinet.staging import delete_stale_uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete chunked uploads in the staging directory which haven't"
+        " received data for a while, e.g. because the client has gone away."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--max-age",
+            type=float,
+            default=24,
+            metavar="HOURS",
+            help="Delete uploads without data for HOURS hours (default: 24).",
+        )
+
+    def handle(self, **options):
+        deleted = delete_stale_uploads(timedelta(hours=options["max_age"]))
+        self.stdout.write(f"Deleted {deleted} stale uploads.")
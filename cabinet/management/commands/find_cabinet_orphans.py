@@ -0,0 +1,199 @@
+import os
+import posixpath
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+from django.apps import apps
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, router
+from django.utils import timezone
+
+from cabinet.base import AbstractFile
+from cabinet.deletion import delete_blobs
+
+
+def file_models():
+    """
+    Return all concrete file models with a database table, e.g.
+    ``cabinet.File`` if it hasn't been swapped out
+    """
+    return [
+        model
+        for model in apps.get_models()
+        if issubclass(model, AbstractFile)
+        and not model._meta.proxy
+        and model._meta.db_table
+        in connections[router.db_for_read(model)].introspection.table_names()
+    ]
+
+
+def upload_prefix(field):
+    """
+    Return the directory containing all uploads of a file field, e.g.
+    ``cabinet`` for ``upload_to="cabinet/%Y/%m"``, or an empty string if it
+    is unknown
+    """
+    if callable(field.upload_to):
+        return ""
+    return posixpath.dirname(field.upload_to.split("%")[0]).strip("/")
+
+
+def walk_storage(storage, path):
+    """
+    Yield the names of all blobs below ``path`` one directory at a time
+    """
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in sorted(files):
+        yield posixpath.join(path, name) if path else name
+    for directory in sorted(directories):
+        yield from walk_storage(storage, posixpath.join(path, directory))
+
+
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, n)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Find blobs in the upload directories which aren't referenced by any"
+        " file, e.g. left behind by failed uploads, and optionally delete them."
+        " Orphans are written to stdout, one name per line."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete the orphans instead of only reporting them.",
+        )
+        parser.add_argument(
+            "--grace-period",
+            type=float,
+            default=24,
+            metavar="HOURS",
+            help=(
+                "Skip blobs modified during the last HOURS hours which may"
+                " belong to uploads in progress (default: 24)."
+            ),
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=16,
+            help="Number of threads talking to the storage.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--prefix",
+            help=(
+                "List blobs below this directory instead of the upload"
+                " directory of the file fields, required if it cannot be"
+                " determined, e.g. if upload_to is a callable."
+            ),
+        )
+
+    def handle(self, **options):
+        self.cutoff = timezone.now() - timedelta(hours=options["grace_period"])
+        # Blobs are listed per storage and upload directory; blobs of image
+        # fields are deleted together with their processed images
+        roots = {}
+        for model in file_models():
+            for name in model.FILE_FIELDS:
+                field = model._meta.get_field(name)
+                prefix = (options["prefix"] or upload_prefix(field)).strip("/")
+                # Never walk the whole storage, it contains processed images
+                # and maybe files of other apps too
+                if not prefix:
+                    raise CommandError(
+                        f"Cannot determine the upload directory of"
+                        f" {model._meta.label}.{name}, pass --prefix."
+                    )
+                key = (field.storage, prefix)
+                if key not in roots or hasattr(field, "_clear_generated_files_for"):
+                    roots[key] = field
+
+        listed = found = size = deleted = failed = 0
+        with (
+            tempfile.TemporaryDirectory() as tmp_dir,
+            ThreadPoolExecutor(max_workers=options["workers"]) as executor,
+        ):
+            # Keep the set of referenced names on disk, not in memory
+            db = sqlite3.connect(os.path.join(tmp_dir, "referenced.sqlite3"))
+            db.execute("CREATE TABLE referenced (name TEXT PRIMARY KEY) WITHOUT ROWID")
+            self._collect_referenced(db, options["batch_size"])
+
+            for (storage, prefix), field in roots.items():
+                for names in batched(
+                    walk_storage(storage, prefix), options["batch_size"]
+                ):
+                    listed += len(names)
+                    referenced = {
+                        row[0]
+                        for row in db.execute(
+                            "SELECT name FROM referenced WHERE name IN (%s)"
+                            % ",".join("?" * len(names)),
+                            names,
+                        )
+                    }
+                    candidates = [name for name in names if name not in referenced]
+                    orphans = [
+                        orphan
+                        for orphan in executor.map(
+                            self._stat, [storage] * len(candidates), candidates
+                        )
+                        if orphan
+                    ]
+                    for name, _size in orphans:
+                        self.stdout.write(name)
+                    found += len(orphans)
+                    size += sum(blob_size for name, blob_size in orphans)
+
+                    if options["delete"] and orphans:
+                        errors = delete_blobs(
+                            field.attr_class(None, field, name) for name, _ in orphans
+                        )
+                        deleted += len(orphans) - len(errors)
+                        failed += len(errors)
+            db.close()
+
+        self.stderr.write(
+            f"Listed {listed} blobs, found {found} orphans"
+            f" ({size / 1024**2:.1f} MiB), deleted {deleted},"
+            f" {failed} deletions failed."
+        )
+
+    def _collect_referenced(self, db, batch_size):
+        for model in file_models():
+            for field in model.FILE_FIELDS:
+                names = (
+                    model._base_manager.exclude(**{field: ""})
+                    .values_list(field, flat=True)
+                    .iterator(chunk_size=batch_size)
+                )
+                for batch in batched(names, batch_size):
+                    db.executemany(
+                        "INSERT OR IGNORE INTO referenced VALUES (?)",
+                        [(name,) for name in batch],
+                    )
+        db.commit()
+
+    def _stat(self, storage, name):
+        """
+        Return the name and size of an unreferenced blob if it is older than
+        the grace period, runs in the worker threads
+        """
+        try:
+            # Aware if USE_TZ is set, same as timezone.now()
+            if storage.get_modified_time(name) >= self.cutoff:
+                return None
+            return name, storage.size(name)
+        except (FileNotFoundError, NotImplementedError):
+            return None
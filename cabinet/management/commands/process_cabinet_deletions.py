@@ -0,0 +1,42 @@
+import time
+
+from django.core.management import BaseCommand
+
+from cabinet.deletion import process_pending_deletions
+
+
+class Command(BaseCommand):
+    help = "Delete the blobs recorded in the deletion queue (CABINET_DELETION_QUEUE)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=10,
+            help="Give up on blobs after this many failed attempts.",
+        )
+        parser.add_argument(
+            "--wait",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help="Keep running and check the queue every SECONDS seconds.",
+        )
+
+    def handle(self, **options):
+        deleted = failed = 0
+        while True:
+            batch_deleted, batch_failed = process_pending_deletions(
+                batch_size=options["batch_size"],
+                max_attempts=options["max_attempts"],
+            )
+            deleted += batch_deleted
+            failed += batch_failed
+            if batch_deleted or batch_failed:
+                continue
+            if not options["wait"]:
+                break
+            time.sleep(options["wait"])
+
+        self.stdout.write(f"Deleted {deleted} blobs, {failed} deletions failed.")
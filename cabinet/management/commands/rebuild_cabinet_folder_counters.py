@@ -0,0 +1,46 @@
+from collections import defaultdict
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from cabinet.models import Folder, get_file_model
+
+
+class Command(BaseCommand):
+    help = "Recalculate the denormalized file and subfolder counters of all folders."
+
+    def handle(self, **options):
+        with transaction.atomic():
+            parents = dict(Folder.objects.values_list("id", "parent"))
+            counters = defaultdict(lambda: [0, 0, 0, 0])
+
+            for parent in parents.values():
+                if parent:
+                    counters[parent][0] += 1
+
+            for folder_id, num_files, size in (
+                get_file_model()
+                ._base_manager.order_by()
+                .values("folder")
+                .annotate(Count("id"), Sum("file_size"))
+                .values_list("folder", "id__count", "file_size__sum")
+            ):
+                counters[folder_id][1] = num_files
+                ancestor = folder_id
+                while ancestor:
+                    counters[ancestor][2] += num_files
+                    counters[ancestor][3] += size
+                    ancestor = parents[ancestor]
+
+            folders = []
+            for folder in Folder.objects.only("id", *Folder.COUNTER_FIELDS):
+                values = counters[folder.id]
+                if [getattr(folder, f) for f in Folder.COUNTER_FIELDS] != values:
+                    for field, value in zip(Folder.COUNTER_FIELDS, values):
+                        setattr(folder, field, value)
+                    folders.append(folder)
+
+            Folder.objects.bulk_update(folders, Folder.COUNTER_FIELDS, batch_size=1000)
+
+        self.stdout.write(f"Updated the counters of {len(folders)} folders.")
@@ -0,0 +1,15 @@
+from django.core.management import BaseCommand
+
+from cabinet.models import get_file_model
+from cabinet.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = "Create the index structures of the configured search backend and index all files."
+
+    def handle(self, **options):
+        backend = get_search_backend()
+        backend.rebuild(get_file_model())
+        self.stdout.write(
+            f"Rebuilt the search index using {backend.__class__.__name__}."
+        )
@@ -0,0 +1,154 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from cabinet.models import Folder, get_file_model
+from cabinet.renditions import generate_renditions
+
+
+def _regenerate(row, force):
+    """
+    Generate the renditions of one image, runs in the worker processes
+    """
+    pk, name, ppoi, width, height = row
+    # Pass the dimensions so that Django doesn't read the image to fill them
+    instance = get_file_model()(
+        pk=pk,
+        image_file=name,
+        image_ppoi=ppoi,
+        image_width=width,
+        image_height=height,
+    )
+    return len(generate_renditions(instance.image_file, force=force))
+
+
+def parse_since(value):
+    if since := parse_datetime(value):
+        pass
+    elif date := parse_date(value):
+        since = datetime.combine(date, datetime.min.time())
+    else:
+        raise CommandError(f"Invalid date {value!r}")
+    if timezone.is_naive(since) and settings.USE_TZ:
+        since = timezone.make_aware(since)
+    return since
+
+
+class Command(BaseCommand):
+    help = "Generate the renditions (admin thumbnails and formats) of images."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--folder",
+            type=int,
+            help="Only process images in this folder and its descendants.",
+        )
+        parser.add_argument(
+            "--since",
+            type=parse_since,
+            help="Only process images modified since this date (and time).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Generate renditions again even if they exist already.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of processes, 1 generates renditions in this process.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--checkpoint",
+            type=Path,
+            help=(
+                "Record the progress in this file and resume from it. The file"
+                " is removed when all images have been processed."
+            ),
+        )
+
+    def handle(self, **options):
+        File = get_file_model()
+        queryset = File._base_manager.exclude(image_file="").order_by("pk")
+        if options["folder"] is not None:
+            try:
+                folder = Folder.objects.get(pk=options["folder"])
+            except Folder.DoesNotExist as exc:
+                raise CommandError(
+                    f"Folder {options['folder']} does not exist"
+                ) from exc
+            queryset = queryset.filter(folder__path__startswith=folder.get_path())
+        if options["since"]:
+            queryset = queryset.filter(updated_at__gte=options["since"])
+
+        last_pk = 0
+        if options["checkpoint"] and options["checkpoint"].exists():
+            last_pk = int(options["checkpoint"].read_text())
+            self.stderr.write(f"Resuming after file {last_pk}.")
+
+        executor = None
+        if options["workers"] > 1:
+            # Never share database connections with the worker processes
+            connections.close_all()
+            executor = ProcessPoolExecutor(
+                max_workers=options["workers"], initializer=django.setup
+            )
+
+        count = failed = 0
+        started = time.monotonic()
+        try:
+            while True:
+                rows = list(
+                    queryset.filter(pk__gt=last_pk).values_list(
+                        "pk", "image_file", "image_ppoi", "image_width", "image_height"
+                    )[: options["batch_size"]]
+                )
+                if not rows:
+                    break
+
+                forces = [options["force"]] * len(rows)
+                if executor:
+                    results = executor.map(_regenerate, rows, forces, chunksize=10)
+                else:
+                    results = map(_regenerate, rows, forces)
+                failed += sum(results)
+                count += len(rows)
+                last_pk = rows[-1][0]
+
+                if options["checkpoint"]:
+                    tmp = options["checkpoint"].with_suffix(".tmp")
+                    tmp.write_text(str(last_pk))
+                    tmp.replace(options["checkpoint"])
+                if options["verbosity"] >= 1:
+                    rate = count / max(time.monotonic() - started, 0.001)
+                    self.stderr.write(
+                        f"{count} images processed, up to file {last_pk}"
+                        f" ({rate:.1f} images/s)"
+                    )
+
+        except KeyboardInterrupt:
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            raise CommandError(
+                f"Interrupted after file {last_pk}; rerun the command with the"
+                " same --checkpoint to resume."
+            ) from None
+
+        if executor:
+            executor.shutdown()
+        if options["checkpoint"]:
+            options["checkpoint"].unlink(missing_ok=True)
+        self.stdout.write(
+            f"Processed {count} images, {failed} renditions could not be generated."
+        )
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0006_alter_folder_unique_together"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="file_hash",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                max_length=64,
+                verbose_name="file hash",
+            ),
+        ),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:14
+
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_counters(apps, schema_editor):
+    Folder = apps.get_model("cabinet", "Folder")
+    File = apps.get_model("cabinet", "File")
+    parents = dict(Folder.objects.values_list("id", "parent"))
+    counters = defaultdict(lambda: [0, 0, 0, 0])
+
+    for parent in parents.values():
+        if parent:
+            counters[parent][0] += 1
+
+    if not File._meta.swapped:
+        # Use ./manage.py rebuild_cabinet_folder_counters for custom file models
+        for folder_id, num_files, size in (
+            File._base_manager.order_by()
+            .values("folder")
+            .annotate(Count("id"), Sum("file_size"))
+            .values_list("folder", "id__count", "file_size__sum")
+        ):
+            counters[folder_id][1] = num_files
+            ancestor = folder_id
+            while ancestor:
+                counters[ancestor][2] += num_files
+                counters[ancestor][3] += size
+                ancestor = parents[ancestor]
+
+    folders = []
+    for pk, values in counters.items():
+        folder = Folder(pk=pk)
+        (
+            folder.num_subfolders,
+            folder.num_files,
+            folder.num_files_recursive,
+            folder.size_recursive,
+        ) = values
+        folders.append(folder)
+    Folder.objects.bulk_update(
+        folders,
+        ["num_subfolders", "num_files", "num_files_recursive", "size_recursive"],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0007_file_file_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="folder",
+            name="num_files",
+            field=models.IntegerField(default=0, editable=False, verbose_name="files"),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="num_files_recursive",
+            field=models.IntegerField(
+                default=0, editable=False, verbose_name="files including subfolders"
+            ),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="num_subfolders",
+            field=models.IntegerField(
+                default=0, editable=False, verbose_name="subfolders"
+            ),
+        ),
+        migrations.AddField(
+            model_name="folder",
+            name="size_recursive",
+            field=models.BigIntegerField(
+                default=0, editable=False, verbose_name="size including subfolders"
+            ),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
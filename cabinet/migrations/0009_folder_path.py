@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:18
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Folder = apps.get_model("cabinet", "Folder")
+    parents = dict(Folder.objects.values_list("id", "parent"))
+    paths = {}
+
+    def path(pk):
+        if pk not in paths:
+            parent = parents[pk]
+            paths[pk] = f"{path(parent) if parent else ''}{pk}/"
+        return paths[pk]
+
+    folders = [Folder(pk=pk, path=path(pk)) for pk in parents]
+    if too_deep := [folder.pk for folder in folders if len(folder.path) > 255]:
+        raise RuntimeError(
+            "The paths of the folders %s would be longer than 255 characters."
+            " Move them closer to the root before migrating."
+            % ", ".join(map(str, too_deep[:10]))
+        )
+    Folder.objects.bulk_update(folders, ["path"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0008_folder_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="folder",
+            name="path",
+            field=models.CharField(
+                blank=True, editable=False, max_length=255, verbose_name="path"
+            ),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="folder",
+            index=models.Index(
+                fields=["path"],
+                name="cabinet_folder_path_idx",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0009_folder_path"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="file",
+            index=models.Index(
+                fields=["folder", "file_name", "id"], name="cabinet_file_keyset"
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:34
+
+from django.db import migrations, models
+
+
+def fill_kind(apps, schema_editor):
+    File = apps.get_model("cabinet", "File")
+    if File._meta.swapped:
+        # Use ./manage.py backfill_cabinet_file_kind for custom file models
+        return
+    for field in ["download_file", "image_file"]:
+        File._base_manager.exclude(**{field: ""}).update(kind=field)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0010_file_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="file",
+            name="kind",
+            field=models.CharField(
+                blank=True, editable=False, max_length=50, verbose_name="kind"
+            ),
+        ),
+        migrations.RunPython(fill_kind, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="file",
+            index=models.Index(fields=["folder", "kind"], name="cabinet_file_kind"),
+        ),
+    ]
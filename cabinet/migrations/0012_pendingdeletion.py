@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:47
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("cabinet", "0011_file_kind"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingDeletion",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created_at",
+                    models.DateTimeField(auto_now_add=True, verbose_name="created at"),
+                ),
+                ("field", models.CharField(max_length=200, verbose_name="field")),
+                ("name", models.CharField(max_length=1000, verbose_name="name")),
+                ("attempts", models.IntegerField(default=0, verbose_name="attempts")),
+                (
+                    "next_attempt_at",
+                    models.DateTimeField(
+                        db_index=True,
+                        default=django.utils.timezone.now,
+                        verbose_name="next attempt at",
+                    ),
+                ),
+                ("last_error", models.TextField(blank=True, verbose_name="last error")),
+            ],
+            options={
+                "verbose_name": "pending deletion",
+                "verbose_name_plural": "pending deletions",
+                "ordering": ["next_attempt_at", "id"],
+            },
+        ),
+    ]
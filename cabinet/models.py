@@ -1,9 +1,11 @@
 from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured, ValidationError
-from django.db import models
-from django.db.models import Q, signals
+from django.db import models, router, transaction
+from django.db.models import F, Max, Q, Value, signals
+from django.db.models.functions import Concat, Length, Substr
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from tree_queries.models import TreeNode
 
@@ -37,10 +39,44 @@ def get_file_model():
         ) from exc
 
 
+def path_ids(path):
+    """
+    Return the primary keys of the folders in a materialized path such as
+    ``"1/5/12/"``, starting at the root
+    """
+    return [int(pk) for pk in path.split("/") if pk]
+
+
 class Folder(TimestampsMixin, TreeNode):
+    COUNTER_FIELDS = [
+        "num_subfolders",
+        "num_files",
+        "num_files_recursive",
+        "size_recursive",
+    ]
+
     name = models.CharField(_("name"), max_length=100)
+    path = models.CharField(_("path"), max_length=255, blank=True, editable=False)
+
+    num_subfolders = models.IntegerField(_("subfolders"), default=0, editable=False)
+    num_files = models.IntegerField(_("files"), default=0, editable=False)
+    num_files_recursive = models.IntegerField(
+        _("files including subfolders"), default=0, editable=False
+    )
+    size_recursive = models.BigIntegerField(
+        _("size including subfolders"), default=0, editable=False
+    )
 
     class Meta:
+        indexes = [
+            # varchar_pattern_ops allows prefix searches using the index even
+            # when not using the C locale; other databases ignore opclasses.
+            models.Index(
+                fields=["path"],
+                name="cabinet_folder_path_idx",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
         ordering = ["name"]
         verbose_name = _("folder")
         verbose_name_plural = _("folders")
@@ -48,6 +84,118 @@ class Folder(TimestampsMixin, TreeNode):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get("parent_id")
+        return instance
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get("using") or router.db_for_write(Folder, instance=self)
+        # Roll back the folder if its path would be too long
+        with transaction.atomic(using=using, savepoint=False):
+            self._save(*args, **kwargs)
+
+    save.alters_data = True
+
+    def _save(self, *args, **kwargs):
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            self.path = f"{self._path_of(self.parent_id)}{self.pk}/"
+            self._check_path_length(len(self.path))
+            Folder.objects.filter(pk=self.pk).update(path=self.path)
+            self.update_counters(self.parent_id, num_subfolders=1)
+            self._loaded_parent_id = self.parent_id
+
+        else:
+            # The path and the counters are maintained using UPDATE queries;
+            # never overwrite them with the possibly outdated values of this
+            # instance
+            update_fields = kwargs.setdefault(
+                "update_fields",
+                [
+                    f.name
+                    for f in self._meta.concrete_fields
+                    if not f.primary_key
+                    and f.name not in {"path", *self.COUNTER_FIELDS}
+                ],
+            )
+            if not {"parent", "parent_id"} & set(update_fields):
+                # The folder isn't moved
+                super().save(*args, **kwargs)
+                return
+
+            old_parent_id = (
+                self._loaded_parent_id
+                if hasattr(self, "_loaded_parent_id")
+                else Folder.objects.filter(pk=self.pk)
+                .values_list("parent", flat=True)
+                .first()
+            )
+            super().save(*args, **kwargs)
+
+            if old_parent_id != self.parent_id:
+                old_path, num_files, size = (
+                    Folder.objects.filter(pk=self.pk)
+                    .values_list("path", "num_files_recursive", "size_recursive")
+                    .get()
+                )
+                old_path = old_path or f"{self._path_of(old_parent_id)}{self.pk}/"
+                # Rewrite the path prefix of the folder and all descendants
+                self.path = f"{self._path_of(self.parent_id)}{self.pk}/"
+                self._check_path_length(
+                    self._subtree_depth(old_path) + len(self.path) - len(old_path)
+                )
+                Folder.objects.filter(path__startswith=old_path).update(
+                    path=Concat(
+                        Value(self.path),
+                        Substr("path", len(old_path) + 1),
+                        output_field=models.CharField(),
+                    )
+                )
+                self.update_counters(
+                    old_parent_id,
+                    num_subfolders=-1,
+                    num_files_recursive=-num_files,
+                    size_recursive=-size,
+                )
+                self.update_counters(
+                    self.parent_id,
+                    num_subfolders=1,
+                    num_files_recursive=num_files,
+                    size_recursive=size,
+                )
+            self._loaded_parent_id = self.parent_id
+
+    @classmethod
+    def update_counters(
+        cls,
+        folder_id,
+        *,
+        num_subfolders=0,
+        num_files=0,
+        num_files_recursive=0,
+        size_recursive=0,
+    ):
+        """
+        Add the given values to the counters of a folder
+
+        The direct counts are only updated on the folder itself, the
+        recursive counts on the folder and all its ancestors.
+        """
+        if not folder_id:
+            return
+        if num_subfolders or num_files:
+            cls.objects.filter(pk=folder_id).update(
+                num_subfolders=F("num_subfolders") + num_subfolders,
+                num_files=F("num_files") + num_files,
+            )
+        if num_files_recursive or size_recursive:
+            cls.objects.filter(pk__in=path_ids(cls._path_of(folder_id))).update(
+                num_files_recursive=F("num_files_recursive") + num_files_recursive,
+                size_recursive=F("size_recursive") + size_recursive,
+            )
+
     def clean(self):
         super().clean()
         if (
@@ -57,9 +205,111 @@ class Folder(TimestampsMixin, TreeNode):
             raise ValidationError(
                 {"name": _("Root folder with same name exists already.")}
             )
+        if self.parent_id:
+            if self.pk:
+                path = self.get_path()
+                depth = self._subtree_depth(path) - len(path) + len(f"{self.pk}/")
+            else:
+                # The primary key isn't known yet, assume the next one
+                last = Folder.objects.aggregate(Max("pk"))["pk__max"] or 0
+                depth = len(f"{last + 1}/")
+            try:
+                self._check_path_length(len(self._path_of(self.parent_id)) + depth)
+            except ValidationError as exc:
+                raise ValidationError({"parent": exc.messages}) from exc
+
+    @classmethod
+    def _check_path_length(cls, length):
+        # Each level needs the digits of the primary key and a slash
+        if length > cls._meta.get_field("path").max_length:
+            raise ValidationError(_("Folders cannot be nested this deeply."))
+
+    @classmethod
+    def _subtree_depth(cls, path):
+        """
+        Return the length of the longest path in the subtree at ``path``
+        """
+        return (
+            cls.objects.filter(path__startswith=path).aggregate(
+                depth=Max(Length("path"))
+            )["depth"]
+            or 0
+        )
+
+    @classmethod
+    def _path_of(cls, folder_id):
+        """
+        Return the path of a folder, or ``""`` if it doesn't exist
+
+        Empty paths of folders inserted without ``save()`` (e.g. by
+        ``loaddata`` or ``bulk_create()``) are filled in.
+        """
+        if not folder_id:
+            return ""
+        row = cls.objects.filter(pk=folder_id).values_list("path", "parent").first()
+        if row is None:
+            return ""
+        path, parent_id = row
+        if not path:
+            path = f"{cls._path_of(parent_id)}{folder_id}/"
+            cls.objects.filter(pk=folder_id).update(path=path)
+        return path
+
+    def get_path(self):
+        """
+        Return the materialized path of the folder, filling it in if it is
+        empty
+
+        Always use this method instead of ``path`` for prefix filters, an
+        empty prefix matches all folders.
+        """
+        if not self.path:
+            if self.pk is None:
+                raise ValueError("Unsaved folders do not have a path.")
+            self.path = self._path_of(self.pk)
+        return self.path
 
     def ancestors_including_self(self):
-        return self.ancestors(include_self=True)
+        return Folder.objects.filter(pk__in=path_ids(self.get_path())).order_by(
+            Length("path")
+        )
+
+    def descendants_including_self(self):
+        return Folder.objects.filter(path__startswith=self.get_path())
+
+
+class PendingDeletion(models.Model):
+    """
+    A blob which should be deleted by ``./manage.py process_cabinet_deletions``
+
+    Only used with ``CABINET_DELETION_QUEUE``. ``field`` is the label of the
+    file field, e.g. ``"cabinet.File.download_file"``.
+    """
+
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    field = models.CharField(_("field"), max_length=200)
+    name = models.CharField(_("name"), max_length=1000)
+    attempts = models.IntegerField(_("attempts"), default=0)
+    next_attempt_at = models.DateTimeField(
+        _("next attempt at"), default=timezone.now, db_index=True
+    )
+    last_error = models.TextField(_("last error"), blank=True)
+
+    class Meta:
+        ordering = ["next_attempt_at", "id"]
+        verbose_name = _("pending deletion")
+        verbose_name_plural = _("pending deletions")
+
+    def __str__(self):
+        return self.name
+
+    def field_file(self):
+        """
+        Return a field file for the blob which isn't attached to a file
+        """
+        app_label, model_name, field_name = self.field.split(".")
+        field = apps.get_model(app_label, model_name)._meta.get_field(field_name)
+        return field.attr_class(None, field, self.name)
 
 
 class File(AbstractFile, ImageMixin, DownloadMixin, OverwriteMixin):
@@ -75,3 +325,19 @@ class File(AbstractFile, ImageMixin, DownloadMixin, OverwriteMixin):
 @receiver(signals.post_delete, sender=File)
 def delete_files(sender, instance, **kwargs):
     instance.delete_files()
+
+
+@receiver(signals.pre_delete, sender=Folder)
+def refresh_counters(sender, instance, using, **kwargs):
+    # The counters of the instance may be outdated
+    instance.refresh_from_db(using=using, fields=["parent", *Folder.COUNTER_FIELDS])
+
+
+@receiver(signals.post_delete, sender=Folder)
+def update_parent_counters(sender, instance, **kwargs):
+    Folder.update_counters(
+        instance.parent_id,
+        num_subfolders=-1,
+        num_files_recursive=-instance.num_files_recursive,
+        size_recursive=-instance.size_recursive,
+    )
@@ -0,0 +1,176 @@
+"""
+Generate renditions of images (the admin thumbnail and the formats of the
+image field) in the background
+
+Renditions of new uploads are generated after the transaction has been
+committed by a pool of ``CABINET_RENDITION_WORKERS`` (defaults to 2) threads.
+The state of renditions is recorded in the cache so that showing a thumbnail
+never decodes the original image. Set ``CABINET_RENDITION_WORKERS`` to ``0``
+to generate renditions synchronously instead, also when they are shown.
+
+The queue of the thread pool isn't persisted, renditions of uploads are lost
+when the process exits before generating them. The admin thumbnail is
+generated again when it is shown, but the formats of the image field are
+not. Run ``./manage.py regenerate_cabinet_renditions --since <date>``
+regularly (e.g. daily) to generate missing renditions.
+"""
+
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+logger = logging.getLogger(__name__)
+
+ADMIN_THUMBNAIL = ["default", ("crop", (50, 50))]
+
+#: Values of the rendition state cache entries
+PENDING, READY, FAILED = "pending", "ready", "failed"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _workers():
+    return getattr(settings, "CABINET_RENDITION_WORKERS", 2)
+
+
+def _get_executor():
+    global _executor  # noqa: PLW0603
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_workers(), thread_name_prefix="cabinet-renditions"
+            )
+        return _executor
+
+
+def cache_key(name):
+    return "cabinet-rendition:%s" % hashlib.sha256(name.encode()).hexdigest()
+
+
+def rendition_name(f_obj, processors):
+    """
+    Return the storage name of a rendition without generating it
+    """
+    return f_obj._process_context(processors).name
+
+
+def rendition_specs(f_obj):
+    """
+    Return the processors of the renditions generated for uploads: the admin
+    thumbnail and the formats of the image field
+    """
+    return [ADMIN_THUMBNAIL, *f_obj.field.formats.values()]
+
+
+def generate_renditions(f_obj, specs=None, *, force=False):
+    """
+    Generate missing (or, with ``force``, all) renditions of an image field
+    file, record their state and return the names of renditions which could
+    not be generated
+    """
+    failed = []
+    for processors in rendition_specs(f_obj) if specs is None else specs:
+        name = rendition_name(f_obj, processors)
+        if not name:
+            continue
+        try:
+            # Returns the name of the original when IMAGEFIELD_SILENTFAILURE
+            # is set and processing fails
+            success = f_obj.process(processors, force=force) == name
+        except Exception:
+            success = False
+        if success:
+            cache.set(cache_key(name), READY, timeout=None)
+        else:
+            logger.warning("Generating %s of %s failed", name, f_obj.name)
+            cache.set(cache_key(name), FAILED)
+            failed.append(name)
+    return failed
+
+
+def forget_renditions(f_obj):
+    """
+    Forget the state of renditions, e.g. because the original is deleted
+    """
+    if hasattr(f_obj, "_process_context"):
+        cache.delete_many(
+            [
+                cache_key(rendition_name(f_obj, processors))
+                for processors in rendition_specs(f_obj)
+            ]
+        )
+
+
+def schedule_renditions(instances, *, using=None):
+    """
+    Generate the renditions of new uploads after the transaction commits
+
+    Only instances whose image has been uploaded since they were loaded are
+    considered.
+    """
+    files = []
+    for instance in instances:
+        if getattr(instance, "_renditions_pending", False):
+            instance._renditions_pending = False
+            if instance.image_file.name:
+                files.append(instance.image_file)
+    if files:
+        transaction.on_commit(lambda: _submit(files), using=using)
+
+
+def _submit(files, specs=None):
+    if _workers() < 1:
+        for f_obj in files:
+            generate_renditions(f_obj, specs)
+        return
+    executor = _get_executor()
+    for f_obj in files:
+        executor.submit(generate_renditions, f_obj, specs)
+
+
+def prefetch_renditions(instances, processors):
+    """
+    Look up the state of a rendition of many files using one cache query
+
+    ``rendition_url()`` uses the prefetched state afterwards.
+    """
+    files = [
+        (instance.image_file, rendition_name(instance.image_file, processors))
+        for instance in instances
+        if instance.image_file.name
+    ]
+    states = cache.get_many([cache_key(name) for f_obj, name in files])
+    for f_obj, name in files:
+        f_obj._rendition_states = {name: states.get(cache_key(name))}
+
+
+def rendition_url(f_obj, processors):
+    """
+    Return the URL of a rendition, ``None`` if it is not available yet or
+    ``""`` if generating it failed
+
+    Missing renditions are generated in the background.
+    """
+    name = rendition_name(f_obj, processors)
+    key = cache_key(name)
+    prefetched = getattr(f_obj, "_rendition_states", {})
+    state = prefetched[name] if name in prefetched else cache.get(key)
+    if state is None and f_obj.storage.exists(name):
+        state = READY
+        cache.set(key, READY, timeout=None)
+    if state is None and cache.add(key, PENDING, timeout=300):
+        _submit([f_obj], [processors])
+        state = cache.get(key)
+
+    if state == READY:
+        return f_obj.storage.url(name)
+    elif state == FAILED:
+        return ""
+    return None
@@ -0,0 +1,313 @@
+"""
+Pluggable search backends for files
+
+Set ``CABINET_SEARCH_BACKEND`` to the dotted path of a backend class. The
+default ``SearchBackend`` uses case-insensitive substring matches (the same
+as Django's admin search); ``SQLiteFTS5SearchBackend`` and
+``PostgresTrigramSearchBackend`` use indexes. The searched fields are the
+``search_fields`` of the file model's admin. Run ``./manage.py
+rebuild_cabinet_search_index`` after switching backends or changing the
+searched fields.
+"""
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router
+from django.db.models import (
+    BooleanField,
+    Case,
+    FloatField,
+    IntegerField,
+    Q,
+    Value,
+    When,
+)
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+from django.utils.text import smart_split, unescape_string_literal
+
+
+def get_search_backend():
+    return _search_backend(
+        getattr(settings, "CABINET_SEARCH_BACKEND", "cabinet.search.SearchBackend")
+    )
+
+
+@lru_cache
+def _search_backend(path):
+    return import_string(path)()
+
+
+def admin_search_fields(model):
+    """
+    Return the ``search_fields`` of the model's admin on the default admin
+    site
+    """
+    # Imported here because the models import this module
+    from django.contrib import admin
+
+    model_admin = admin.site._registry.get(model)
+    return model_admin.search_fields if model_admin else ["file_name"]
+
+
+def prepare_search_index(using, **kwargs):
+    """
+    Create the index structures of the search backend after migrating
+    """
+    from cabinet.models import get_file_model
+
+    model = get_file_model()
+    if router.allow_migrate_model(using, model):
+        get_search_backend().prepare(model, using=using)
+
+
+def search_terms(query):
+    """
+    Split the query into terms like the admin does, quoted terms may contain
+    spaces
+    """
+    terms = []
+    for bit in smart_split(query):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            terms.append(unescape_string_literal(bit))
+        else:
+            terms.append(bit)
+    return [term for term in terms if term]
+
+
+class SearchBackend:
+    """
+    Search files using case-insensitive substring matches
+
+    Files have to match all terms in at least one of ``fields``. The
+    ``search_rank`` annotation prefers files whose name starts with the query.
+    """
+
+    #: Searched fields, defaults to the ``search_fields`` of the admin
+    fields = None
+
+    def get_fields(self, model):
+        """
+        Return those searched fields which are concrete fields of the file
+        model; lookup prefixes such as ``^`` are ignored
+        """
+        fields = []
+        for name in self.fields or admin_search_fields(model):
+            try:
+                field = model._meta.get_field(name.lstrip("^=@"))
+            except FieldDoesNotExist:
+                continue
+            if field.concrete and not field.is_relation:
+                fields.append(field)
+        return fields
+
+    def filter_term(self, queryset, term):
+        q = Q()
+        for field in self.get_fields(queryset.model):
+            q |= Q(**{f"{field.name}__icontains": term})
+        return queryset.filter(q)
+
+    def search(self, queryset, query):
+        """
+        Return files matching the query with a ``search_rank`` annotation;
+        higher ranks are better matches
+        """
+        for term in search_terms(query):
+            queryset = self.filter_term(queryset, term)
+        return queryset.annotate(
+            search_rank=Case(
+                When(file_name__iexact=query, then=Value(2)),
+                When(file_name__istartswith=query, then=Value(1)),
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        )
+
+    def index(self, instances):
+        """
+        Add or update the index entries of files
+        """
+
+    def remove(self, instances):
+        """
+        Remove the index entries of files
+        """
+
+    def prepare(self, model, *, using=None):
+        """
+        Create the index structures if they do not exist yet
+        """
+
+    def rebuild(self, model):
+        """
+        Create the index structures and index all files
+        """
+
+
+class SQLiteFTS5SearchBackend(SearchBackend):
+    """
+    Search files using a FTS5 shadow table with the trigram tokenizer
+
+    The shadow table (``<db_table>_fts``) is created by ``migrate`` and
+    ``rebuild_cabinet_search_index`` and kept up to date when files are saved
+    or deleted. The trigram tokenizer supports substring matches, but only for
+    terms of three or more characters; shorter terms fall back to
+    ``icontains``. Requires SQLite 3.34 or better.
+    """
+
+    def _columns(self, model):
+        return ", ".join(field.column for field in self.get_fields(model))
+
+    def _table(self, model, connection):
+        return connection.ops.quote_name(f"{model._meta.db_table}_fts")
+
+    def prepare(self, model, *, using=None):
+        connection = connections[using or router.db_for_write(model)]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self._table(model, connection)}"
+                f" USING fts5({self._columns(model)}, tokenize='trigram')"
+            )
+
+    def search(self, queryset, query):
+        model = queryset.model
+        connection = connections[queryset.db]
+        terms = []
+        for term in search_terms(query):
+            if len(term) < 3:
+                queryset = self.filter_term(queryset, term)
+            else:
+                terms.append('"{}"'.format(term.replace('"', '""')))
+        if not terms:
+            return queryset.annotate(search_rank=Value(0.0, FloatField()))
+
+        table = self._table(model, connection)
+        match = " AND ".join(terms)
+        quote = connection.ops.quote_name
+        pk = f"{quote(model._meta.db_table)}.{quote(model._meta.pk.column)}"
+        return queryset.filter(
+            pk__in=RawSQL(f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [match])
+        ).annotate(
+            # FTS5's rank is the negative BM25 score
+            search_rank=RawSQL(
+                f"SELECT -rank FROM {table} WHERE {table} MATCH %s AND rowid = {pk}",
+                [match],
+                output_field=FloatField(),
+            )
+        )
+
+    def index(self, instances):
+        instances = list(instances)
+        if not instances:
+            return
+        model = instances[0].__class__
+        connection = connections[router.db_for_write(model)]
+        table = self._table(model, connection)
+        fields = self.get_fields(model)
+        rows = [
+            [instance.pk, *(getattr(instance, f.attname) for f in fields)]
+            for instance in instances
+            if instance.pk
+        ]
+        # bulk_create() doesn't set the primary keys on all databases and
+        # Django versions (e.g. SQLite before Django 4.0); index all files
+        # referencing the blobs of those files instead
+        blobs = {}
+        for instance in instances:
+            if not instance.pk:
+                blobs.setdefault(instance.file.field.name, set()).add(
+                    instance.file.name
+                )
+        if blobs:
+            q = Q()
+            for field, names in blobs.items():
+                q |= Q(**{f"{field}__in": names})
+            rows.extend(
+                model._base_manager.using(connection.alias)
+                .filter(q)
+                .values_list("pk", *(f.attname for f in fields))
+            )
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {table} (rowid, {self._columns(model)})"
+                f" VALUES (%s{', %s' * len(fields)})",
+                rows,
+            )
+
+    def remove(self, instances):
+        instances = [instance for instance in instances if instance.pk]
+        if not instances:
+            return
+        model = instances[0].__class__
+        connection = connections[router.db_for_write(model)]
+        table = self._table(model, connection)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"DELETE FROM {table} WHERE rowid = %s",
+                [[instance.pk] for instance in instances],
+            )
+
+    def rebuild(self, model):
+        connection = connections[router.db_for_write(model)]
+        columns = self._columns(model)
+        table = self._table(model, connection)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            self.prepare(model, using=connection.alias)
+            cursor.execute(
+                f"INSERT INTO {table} (rowid, {columns})"
+                f" SELECT {connection.ops.quote_name(model._meta.pk.column)}, {columns}"
+                f" FROM {connection.ops.quote_name(model._meta.db_table)}"
+            )
+
+
+class PostgresTrigramSearchBackend(SearchBackend):
+    """
+    Search files using a trigram index on PostgreSQL
+
+    ``rebuild()`` creates the ``pg_trgm`` extension and a GIN index on the
+    concatenation of the searched fields; the database keeps the index up to
+    date by itself. Files are ordered by their word similarity to the query.
+    """
+
+    def _document(self, model, table=None):
+        quote = connections[router.db_for_read(model)].ops.quote_name
+        prefix = f"{quote(table)}." if table else ""
+        return "({})".format(
+            " || ' ' || ".join(
+                f"{prefix}{quote(f.column)}" for f in self.get_fields(model)
+            )
+        )
+
+    def search(self, queryset, query):
+        model = queryset.model
+        document = self._document(model, model._meta.db_table)
+        for term in search_terms(query):
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            queryset = queryset.filter(
+                RawSQL(
+                    f"{document} ILIKE %s",
+                    [f"%{escaped}%"],
+                    output_field=BooleanField(),
+                )
+            )
+        return queryset.annotate(
+            search_rank=RawSQL(
+                f"word_similarity(%s, {document})", [query], output_field=FloatField()
+            )
+        )
+
+    def rebuild(self, model):
+        connection = connections[router.db_for_write(model)]
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            # The searched fields may have changed
+            index = quote(f"{model._meta.db_table}_search_trgm")
+            cursor.execute(f"DROP INDEX IF EXISTS {index}")
+            cursor.execute(
+                f"CREATE INDEX {index} ON {quote(model._meta.db_table)}"
+                f" USING gin ({self._document(model)} gin_trgm_ops)"
+            )
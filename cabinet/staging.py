@@ -0,0 +1,152 @@
+import contextlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files import locks
+from django.core.files.base import File
+
+
+_UPLOAD_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def staging_dir():
+    """
+    Return the directory where chunked uploads are assembled
+
+    Defaults to a ``cabinet-uploads`` folder inside ``FILE_UPLOAD_TEMP_DIR``
+    (or the system temporary directory), set ``CABINET_UPLOAD_STAGING_DIR``
+    to override it. Staging on the same filesystem as the storage allows
+    moving finished uploads into place instead of copying them.
+    """
+    return getattr(
+        settings,
+        "CABINET_UPLOAD_STAGING_DIR",
+        os.path.join(
+            settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), "cabinet-uploads"
+        ),
+    )
+
+
+def delete_stale_uploads(max_age):
+    """
+    Delete chunked uploads which haven't received data for ``max_age`` (a
+    ``timedelta``), e.g. because the client has gone away, and return their
+    number
+    """
+    cutoff = time.time() - max_age.total_seconds()
+    try:
+        entries = list(os.scandir(staging_dir()))
+    except FileNotFoundError:
+        return 0
+
+    modified = {}
+    for entry in entries:
+        upload_id, ext = os.path.splitext(entry.name)
+        if ext not in {".part", ".json"} or not _UPLOAD_ID_RE.match(upload_id):
+            continue
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        modified[upload_id] = max(modified.get(upload_id, 0), mtime)
+
+    stale = [upload_id for upload_id, mtime in modified.items() if mtime < cutoff]
+    for upload_id in stale:
+        for ext in (".part", ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(staging_dir(), f"{upload_id}{ext}"))
+    return len(stale)
+
+
+class StagedFile(File):
+    """
+    A finished chunked upload
+
+    Has a ``temporary_file_path`` like Django's ``TemporaryUploadedFile``,
+    which allows ``FileSystemStorage`` to move the file into place.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+class StagedUpload:
+    """
+    A chunked upload which is assembled in the staging directory
+
+    Chunks are appended to a ``.part`` file; the upload's metadata (target
+    folder, file name and the announced size) lives in a ``.json`` file next
+    to it. The current size of the ``.part`` file is the offset where the
+    next chunk has to start, which makes resuming interrupted uploads
+    possible.
+    """
+
+    def __init__(self, upload_id):
+        if not _UPLOAD_ID_RE.match(upload_id):
+            raise LookupError(upload_id)
+        self.id = upload_id
+        base = os.path.join(staging_dir(), upload_id)
+        self.part_path = f"{base}.part"
+        self.meta_path = f"{base}.json"
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except FileNotFoundError as exc:
+            raise LookupError(upload_id) from exc
+
+    @classmethod
+    def create(cls, *, folder_id, name, size):
+        os.makedirs(staging_dir(), exist_ok=True)
+        upload_id = secrets.token_hex(16)
+        base = os.path.join(staging_dir(), upload_id)
+        with open(f"{base}.part", "xb"):
+            pass
+        with open(f"{base}.json", "x") as f:
+            json.dump(
+                {"folder": folder_id, "name": os.path.basename(name), "size": size},
+                f,
+            )
+        return cls(upload_id)
+
+    @property
+    def offset(self):
+        return os.path.getsize(self.part_path)
+
+    @property
+    def complete(self):
+        return self.offset == self.meta["size"]
+
+    def append(self, offset, stream):
+        """
+        Append the contents of ``stream`` to the upload if ``offset`` matches
+        the current offset. Returns ``False`` if it doesn't or if ``stream``
+        contains more data than announced when creating the upload.
+        """
+        with open(self.part_path, "ab") as part:
+            # Requests sending the same chunk twice must not both pass the
+            # offset check; the lock is released when closing the file
+            locks.lock(part, locks.LOCK_EX)
+            if offset != part.seek(0, os.SEEK_END):
+                return False
+            shutil.copyfileobj(stream, part)
+            if part.tell() > self.meta["size"]:
+                part.truncate(offset)
+                return False
+        return True
+
+    def open(self):
+        return StagedFile(open(self.part_path, "rb"), name=self.meta["name"])
+
+    def delete(self):
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # The storage may have moved the .part file into place
+                pass
@@ -58,32 +58,211 @@ django.jQuery(($) => {
     uploadFiles(e.target.files)
   })
 
-  function uploadFiles(files) {
-    let success = 0
-    const progress = $(`<div class="progress">0 / ${files.length}</div>`)
+  // Files larger than this are sent in chunks which can be resumed when the
+  // connection drops
+  const CHUNKED_UPLOAD_THRESHOLD = 16 * 1024 * 1024
+  const CHUNK_SIZE = 8 * 1024 * 1024
+  // Limits for the number and total size of files sent in one request
+  const BATCH_FILES = 50
+  const BATCH_SIZE = 32 * 1024 * 1024
+
+  const csrfToken = () => $("input[name=csrfmiddlewaretoken]").val()
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms))
+
+  async function chunkedUpload(file, onProgress) {
+    // Remember the upload so that it may be resumed after reloading the page
+    const key = `cabinet-upload:${folder[1]}:${file.name}:${file.size}:${file.lastModified}`
+    let upload = window.localStorage.getItem(key)
+    let offset = 0
+
+    if (upload) {
+      const response = await fetch(`./upload/chunked/${upload}/`)
+      if (response.ok) {
+        offset = (await response.json()).offset
+      } else {
+        upload = null
+      }
+    }
+
+    if (!upload) {
+      const d = new FormData()
+      d.append("csrfmiddlewaretoken", csrfToken())
+      d.append("folder", folder[1])
+      d.append("name", file.name)
+      d.append("size", file.size)
+      const response = await fetch("./upload/chunked/", {
+        method: "POST",
+        body: d,
+      })
+      if (!response.ok) throw new Error(`Upload of ${file.name} failed`)
+      upload = (await response.json()).upload
+      window.localStorage.setItem(key, upload)
+    }
 
+    let failures = 0
+    while (offset < file.size) {
+      onProgress(offset / file.size)
+      const response = await fetch(
+        `./upload/chunked/${upload}/?offset=${offset}`,
+        {
+          method: "PUT",
+          headers: { "X-CSRFToken": csrfToken() },
+          body: file.slice(offset, offset + CHUNK_SIZE),
+        },
+      ).catch(() => null)
+
+      if (response?.ok) {
+        offset = (await response.json()).offset
+        failures = 0
+        continue
+      }
+      if (++failures > 5) throw new Error(`Upload of ${file.name} failed`)
+      if (response?.status === 409) {
+        // The server has a different idea of where to continue
+        offset = (await response.json()).offset
+      } else {
+        await sleep(1000 * 2 ** failures)
+      }
+    }
+
+    const d = new FormData()
+    d.append("csrfmiddlewaretoken", csrfToken())
+    const response = await fetch(`./upload/chunked/${upload}/finalize/`, {
+      method: "POST",
+      body: d,
+    })
+    if (!response.ok) throw new Error(`Upload of ${file.name} failed`)
+    window.localStorage.removeItem(key)
+  }
+
+  // Files larger than this aren't hashed before uploading since the
+  // browser has to load them into memory for hashing
+  const HASH_MAX_SIZE = 256 * 1024 * 1024
+  const hashWorkerUrl = cabinetUpload.data("hash-worker")
+
+  // Hashes one file after the other so that the worker holds at most one
+  // file in memory
+  async function hashFiles(files) {
+    const worker = new Worker(hashWorkerUrl)
+    const hashes = []
+    try {
+      for (const [id, file] of files.entries()) {
+        hashes.push(
+          await new Promise((resolve) => {
+            worker.onmessage = (e) => resolve(e.data.hash)
+            worker.onerror = () => resolve(undefined)
+            worker.postMessage({ id, file })
+          }),
+        )
+      }
+    } finally {
+      worker.terminate()
+    }
+    return hashes
+  }
+
+  // Adds files which exist already without uploading them, returns the
+  // files which still have to be uploaded.
+  async function addExistingFiles(files) {
+    const candidates = files.filter((file) => file.size <= HASH_MAX_SIZE)
+    if (!hashWorkerUrl || !window.crypto?.subtle || !candidates.length) {
+      return files
+    }
+
+    const hashes = await hashFiles(candidates)
+    const response = await fetch("./upload/check/", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "X-CSRFToken": csrfToken(),
+      },
+      body: JSON.stringify({
+        folder: folder[1],
+        files: candidates
+          .map((file, i) => ({
+            hash: hashes[i],
+            size: file.size,
+            name: file.name,
+          }))
+          .filter((row) => row.hash),
+      }),
+    })
+    if (!response.ok) return files
+
+    const existing = new Set()
+    for (const row of (await response.json()).files) {
+      if (row.exists) existing.add(row.hash)
+    }
+    return files.filter((file) => {
+      const i = candidates.indexOf(file)
+      return i < 0 || !existing.has(hashes[i])
+    })
+  }
+
+  async function uploadFiles(fileList) {
+    const progress = $('<div class="progress">…</div>')
     progress.appendTo(results)
 
-    for (let i = 0; i < files.length; ++i) {
+    const allFiles = Array.from(fileList)
+    const files = await addExistingFiles(allFiles).catch(() => allFiles)
+    if (!files.length) {
+      window.location.reload()
+      return
+    }
+
+    let success = 0
+    progress.html(`0 / ${files.length}`)
+
+    const uploaded = () => {
+      progress.html(`${++success} / ${files.length}`)
+      if (success >= files.length) {
+        window.location.reload()
+      }
+    }
+
+    // Small files are sent in batches, large files in chunks
+    const batches = []
+    let current = null
+    for (const file of files) {
+      if (file.size >= CHUNKED_UPLOAD_THRESHOLD) {
+        chunkedUpload(file, (fraction) => {
+          progress.html(
+            `${Math.round(fraction * 100)}% of ${success + 1} / ${files.length}`,
+          )
+        }).then(uploaded, (error) => {
+          progress.html(error.message)
+        })
+        continue
+      }
+
+      if (
+        !current ||
+        current.files.length >= BATCH_FILES ||
+        current.size + file.size > BATCH_SIZE
+      ) {
+        current = { files: [], size: 0 }
+        batches.push(current)
+      }
+      current.files.push(file)
+      current.size += file.size
+    }
+
+    for (const batch of batches) {
       const d = new FormData()
-      d.append(
-        "csrfmiddlewaretoken",
-        $("input[name=csrfmiddlewaretoken]").val(),
-      )
+      d.append("csrfmiddlewaretoken", csrfToken())
       d.append("folder", folder[1])
-      d.append("file", files[i])
+      for (const file of batch.files) {
+        d.append("files", file)
+      }
 
       $.ajax({
-        url: "./upload/",
+        url: "./upload/batch/",
         type: "POST",
         data: d,
         contentType: false,
         processData: false,
         success: () => {
-          progress.html(`${++success} / ${files.length}`)
-          if (success >= files.length) {
-            window.location.reload()
-          }
+          for (let i = 0; i < batch.files.length; ++i) uploaded()
         },
         xhr: () => {
           const xhr = new XMLHttpRequest()
@@ -92,7 +271,7 @@ django.jQuery(($) => {
             (e) => {
               if (e.lengthComputable) {
                 progress.html(
-                  `${Math.round((e.loaded / e.total) * 100)}% of ${success + 1} / ${files.length}`,
+                  `${Math.round((e.loaded / e.total) * 100)}% of ${success + batch.files.length} / ${files.length}`,
                 )
               }
             },
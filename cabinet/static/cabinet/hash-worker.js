@@ -0,0 +1,18 @@
+// Computes SHA-256 digests of files off the main thread for the
+// "do you already have this file?" check before uploading. cabinet.js sends
+// the next file only after receiving the digest of the previous one.
+self.onmessage = async (e) => {
+  const { id, file } = e.data
+  try {
+    const digest = await crypto.subtle.digest(
+      "SHA-256",
+      await file.arrayBuffer(),
+    )
+    const hash = Array.from(new Uint8Array(digest), (byte) =>
+      byte.toString(16).padStart(2, "0"),
+    ).join("")
+    self.postMessage({ id, hash })
+  } catch (error) {
+    self.postMessage({ id, error: `${error}` })
+  }
+}
@@ -0,0 +1,127 @@
+"""
+Upload handlers which inspect files while they are being received
+
+Add them to your settings instead of Django's default handlers::
+
+    FILE_UPLOAD_HANDLERS = [
+        "cabinet.uploadhandlers.MemoryFileUploadHandler",
+        "cabinet.uploadhandlers.TemporaryFileUploadHandler",
+    ]
+
+Uploaded files get a ``cabinet_metadata`` dictionary with the size, the hex
+SHA-256 digest, the first ``HEAD_SIZE`` bytes (``head``) and the result of
+``image_info(head)`` (``image``). ``upload_is_image`` and ``AbstractFile.prepare_save``
+use the metadata instead of reading the upload again.
+
+If ``IMAGEFIELD_VALIDATE_ON_SAVE`` is enabled, images are also decoded while
+being received; the ``image`` dictionary's ``verified`` key tells whether the
+image data is intact.
+"""
+
+import contextlib
+import hashlib
+import io
+
+from django.conf import settings
+from django.core.files import uploadhandler
+from PIL import Image, ImageFile
+
+from cabinet.base import max_image_pixels
+
+
+HEAD_SIZE = 64 * 1024
+
+
+def image_info(head):
+    """
+    Return the format and dimensions of the image starting with ``head``,
+    ``False`` if ``head`` isn't the start of an image, or ``None`` if that
+    cannot be determined without reading more data
+    """
+    with contextlib.suppress(Exception), Image.open(io.BytesIO(head)) as image:
+        return {
+            "format": image.format,
+            "width": image.size[0],
+            "height": image.size[1],
+        }
+
+    # Image.open() has tried all plugins now. Unless one of them recognizes
+    # the prefix (the header may be larger than the head), this isn't an image.
+    prefix = head[:16]
+    for _factory, accept in Image.OPEN.values():
+        # Raises if the prefix is too short
+        with contextlib.suppress(Exception):
+            if accept and accept(prefix):
+                return None
+    return False
+
+
+class UploadMetadataMixin:
+    def new_file(self, *args, **kwargs):
+        # Reset before calling super(), MemoryFileUploadHandler raises
+        # StopFutureHandlers when it handles the file itself.
+        self.cabinet_hash = hashlib.sha256()
+        self.cabinet_head = bytearray()
+        self.cabinet_parser = (
+            ImageFile.Parser()
+            if getattr(settings, "IMAGEFIELD_VALIDATE_ON_SAVE", True)
+            else None
+        )
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # MemoryFileUploadHandler passes chunks on if the upload is too large
+        if getattr(self, "activated", True):
+            self.cabinet_hash.update(raw_data)
+            if len(self.cabinet_head) < HEAD_SIZE:
+                self.cabinet_head += raw_data[: HEAD_SIZE - len(self.cabinet_head)]
+            if self.cabinet_parser:
+                self._decode(raw_data, start)
+        return super().receive_data_chunk(raw_data, start)
+
+    def _decode(self, raw_data, start):
+        # Decoding allocates the image, only decode images whose dimensions
+        # are known and acceptable after the first chunk
+        if start == 0:
+            info = image_info(raw_data)
+            limit = max_image_pixels()
+            if not info or (limit and info["width"] * info["height"] > limit):
+                self.cabinet_parser = None
+                return
+        try:
+            self.cabinet_parser.feed(raw_data)
+        except Exception:  # OSError, SyntaxError, DecompressionBombError
+            self.cabinet_parser = False
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            head = bytes(self.cabinet_head)
+            info = image_info(head)
+            if info and self.cabinet_parser is False:
+                info["verified"] = False
+            elif info and self.cabinet_parser:
+                try:
+                    with self.cabinet_parser.close():
+                        info["verified"] = True
+                except Exception:  # Truncated data
+                    info["verified"] = False
+            file.cabinet_metadata = {
+                "size": file_size,
+                "hash": self.cabinet_hash.hexdigest(),
+                "head": head,
+                "image": info,
+            }
+        return file
+
+
+class MemoryFileUploadHandler(
+    UploadMetadataMixin, uploadhandler.MemoryFileUploadHandler
+):
+    pass
+
+
+class TemporaryFileUploadHandler(
+    UploadMetadataMixin, uploadhandler.TemporaryFileUploadHandler
+):
+    pass
@@ -18,6 +18,9 @@ INSTALLED_APPS = [
     "imagefield",
 ]
 
+# Generate renditions synchronously
+CABINET_RENDITION_WORKERS = 0
+
 MEDIA_URL = "/media/"
 STATIC_URL = "/static/"
 BASEDIR = os.path.dirname(__file__)
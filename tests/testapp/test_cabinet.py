@@ -1,3 +1,4 @@
+import importlib
 import io
 import itertools
 import json
@@ -6,20 +7,45 @@ import shutil
 import tempfile
 from pathlib import Path
 from unittest.mock import patch
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
 from django import forms
+from django.apps import apps as django_apps
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files import locks
 from django.core.files.base import ContentFile
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.forms import modelform_factory
 from django.test import Client, TestCase
-from django.test.utils import override_settings
+from django.test.utils import (
+    CaptureQueriesContext,
+    isolate_apps,
+    override_settings,
+)
 from django.urls import reverse
-
-from cabinet.base import AbstractFile, DownloadMixin, determine_accept_file_functions
-from cabinet.models import File, Folder, get_file_model
+from django.utils import timezone
+
+from cabinet.admin import FileAdmin
+from cabinet.base import (
+    AbstractFile,
+    DownloadMixin,
+    DownloadTypeClassifier,
+    determine_accept_file_functions,
+    upload_is_image,
+    verify_image,
+)
+from cabinet.deletion import unreferenced_files
+from cabinet.management.commands.check_cabinet_files import (
+    Command as CheckFilesCommand,
+)
+from cabinet.models import File, Folder, PendingDeletion, get_file_model
+from cabinet.renditions import ADMIN_THUMBNAIL, rendition_name
+from cabinet.search import get_search_backend
+from cabinet.staging import StagedUpload
 from testapp.models import Stuff
 
 
@@ -32,6 +58,7 @@ class CabinetTestCase(TestCase):
         self.image2_path = os.path.join(settings.BASE_DIR, "image-neg.png")
         if os.path.exists(settings.MEDIA_ROOT):
             shutil.rmtree(settings.MEDIA_ROOT)
+        cache.clear()
 
     def login(self):
         client = Client()
@@ -39,7 +66,8 @@ class CabinetTestCase(TestCase):
         return client
 
     def assertNoMediaFiles(self):
-        File.objects.all().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            File.objects.all().delete()
         files = list(
             itertools.chain.from_iterable(i[2] for i in os.walk(settings.MEDIA_ROOT))
         )
@@ -90,7 +118,8 @@ class CabinetTestCase(TestCase):
         self.assertRedirects(response, "/admin/cabinet/file/")
         self.assertEqual(Folder.objects.count(), 1)  # not deleted
 
-        file.delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
 
         # Create a subfolder, but deleting should succeed anyway
         Folder.objects.create(parent=folder, name="Anything")
@@ -269,6 +298,63 @@ class CabinetTestCase(TestCase):
 
         self.assertNoMediaFiles()
 
+    def test_batch_upload(self):
+        c = self.login()
+        f = Folder.objects.create(name="Test")
+
+        response = c.post("/admin/cabinet/file/upload/batch/", {})
+        self.assertEqual(response.status_code, 400)
+
+        with (
+            open(self.image1_path, "rb") as image,
+            io.BytesIO(b"Hello") as text,
+            io.BytesIO(b"") as empty,
+        ):
+            text.name = "hello.txt"
+            empty.name = "empty.txt"
+            response = c.post(
+                "/admin/cabinet/file/upload/batch/",
+                {"folder": f.id, "files": [image, text, empty]},
+            )
+
+        data = response.json()
+        self.assertEqual(data["success"], True)
+        self.assertEqual(
+            [(row["success"], row["name"]) for row in data["files"]],
+            [(True, "image.png"), (True, "hello.txt"), (False, "empty.txt")],
+        )
+
+        text, image = File.objects.order_by("file_name")
+        self.assertEqual(image.download_type, "")
+        self.assertEqual((image.image_width, image.image_height), (76, 66))
+        self.assertEqual(text.download_type, "txt")
+        self.assertEqual(text.file_size, 5)
+        self.assertEqual(text.download_file.read(), b"Hello")
+        f.refresh_from_db()
+        self.assertEqual(f.num_files, 2)
+        self.assertEqual(f.size_recursive, image.file_size + 5)
+
+        self.assertNoMediaFiles()
+
+    def test_batch_upload_failure(self):
+        c = self.login()
+        f = Folder.objects.create(name="Test")
+
+        with (
+            io.BytesIO(b"Hello") as text,
+            patch("cabinet.base_admin.get_search_backend") as backend,
+        ):
+            backend.return_value.index.side_effect = RuntimeError
+            text.name = "hello.txt"
+            with self.assertRaises(RuntimeError):
+                c.post(
+                    "/admin/cabinet/file/upload/batch/",
+                    {"folder": f.id, "files": [text]},
+                )
+
+        self.assertEqual(File.objects.count(), 0)
+        self.assertNoMediaFiles()
+
     def test_raw_id_fields(self):
         c = self.login()
         response = c.get("/admin/cabinet/file/?_to_field=id&_popup=1")
@@ -367,6 +453,46 @@ class CabinetTestCase(TestCase):
         file.refresh_from_db()
         self.assertFalse(file._overwrite)
 
+    def test_save_uses_loaded_state(self):
+        folder = Folder.objects.create(name="Root")
+        file = File(folder=folder)
+        file.download_file.save("hello.txt", ContentFile("Hello"))
+        old_name = file.download_file.name
+
+        file = File.objects.get()
+        file.caption = "Hello world"
+        with self.assertNumQueries(1):  # Only the UPDATE
+            file.save()
+
+        file.file = ContentFile("World", name="world.txt")
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(1):
+                file.save()
+            # The old blob is deleted after committing
+            self.assertTrue(file.download_file.storage.exists(old_name))
+        self.assertFalse(file.download_file.storage.exists(old_name))
+
+        # The state recorded by save() is used too
+        old_name = file.download_file.name
+        file.file = ContentFile("Again", name="again.txt")
+        with (
+            self.captureOnCommitCallbacks(execute=True),
+            self.assertNumQueries(1),
+        ):
+            file.save()
+        self.assertFalse(file.download_file.storage.exists(old_name))
+
+        # Instances not loaded from the database query the original row
+        copy = File.objects.get()
+        copy = File(**{f.attname: getattr(copy, f.attname) for f in File._meta.fields})
+        copy.caption = "Copy"
+        with self.assertNumQueries(2):
+            copy.save()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            file.delete()
+        self.assertNoMediaFiles()
+
     def test_invalid_folder(self):
         c = self.login()
         response = c.get("/admin/cabinet/file/?folder__id__exact=anything")
@@ -449,6 +575,95 @@ class CabinetTestCase(TestCase):
         response = c.get(f"/admin/cabinet/file/?folder__id__exact={folder.id}")
         self.assertContains(response, '<span class="broken-image"></span>', 1)
 
+    def test_upload_is_image(self):
+        with open(self.image1_path, "rb") as image:
+            image1_bytes = image.read()
+
+        upload = ContentFile(image1_bytes, name="image.png")
+        self.assertTrue(upload_is_image(upload))
+        self.assertEqual(upload.tell(), 0)
+
+        truncated = ContentFile(image1_bytes[:500], name="image.png")
+        # The header is fine, the image data is not
+        self.assertTrue(upload_is_image(truncated))
+        self.assertFalse(upload_is_image(truncated, verify=True))
+        self.assertFalse(verify_image(truncated))
+        self.assertFalse(upload_is_image(ContentFile(b"invalid", name="image.png")))
+
+        with override_settings(CABINET_MAX_IMAGE_PIXELS=76 * 66 - 1):
+            self.assertFalse(upload_is_image(upload))
+
+            c = self.login()
+            f = Folder.objects.create(name="Test")
+            with open(self.image1_path, "rb") as image:
+                response = c.post(
+                    "/admin/cabinet/file/upload/", {"folder": f.id, "file": image}
+                )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(File.objects.get().download_type, "image")
+
+        self.assertNoMediaFiles()
+
+    @override_settings(
+        FILE_UPLOAD_HANDLERS=[
+            "cabinet.uploadhandlers.MemoryFileUploadHandler",
+            "cabinet.uploadhandlers.TemporaryFileUploadHandler",
+        ]
+    )
+    def test_upload_handler_metadata(self):
+        c = self.login()
+        f = Folder.objects.create(name="Test")
+        with (
+            patch("cabinet.base._is_image") as is_image,
+            patch("cabinet.base.content_hash") as content_hash,
+        ):
+            with open(self.image1_path, "rb") as image:
+                response = c.post(
+                    "/admin/cabinet/file/upload/", {"folder": f.id, "file": image}
+                )
+            self.assertEqual(response.status_code, 200)
+
+            with io.BytesIO(b"0123456789" * 1024 * 1024) as file:
+                file.name = "blob.txt"
+                response = c.post(
+                    "/admin/cabinet/file/upload/", {"folder": f.id, "file": file}
+                )
+            self.assertEqual(response.status_code, 200)
+
+        # Uploads are not read again to determine their hash, and images are
+        # decoded while being received (because of IMAGEFIELD_VALIDATE_ON_SAVE)
+        self.assertEqual(is_image.call_count, 0)
+        self.assertEqual(content_hash.call_count, 0)
+
+        blob, image = File.objects.order_by("file_name")
+        self.assertEqual((image.image_width, image.image_height), (76, 66))
+        self.assertEqual(len(image.file_hash), 64)
+        self.assertEqual(blob.download_type, "txt")
+        self.assertEqual(blob.file_size, 10 * 1024 * 1024)
+
+        # The header info collected while uploading is sufficient
+        upload = ContentFile(b"", name="image.png")
+        upload.cabinet_metadata = {
+            "image": {"format": "PNG", "width": 76, "height": 66}
+        }
+        self.assertTrue(upload_is_image(upload))
+        with override_settings(CABINET_MAX_IMAGE_PIXELS=100):
+            self.assertFalse(upload_is_image(upload))
+
+        # Corrupt images are detected while being received
+        with open(self.image1_path, "rb") as image:
+            truncated = io.BytesIO(image.read()[:-100])
+        truncated.name = "truncated.png"
+        with patch("cabinet.base._is_image") as is_image:
+            response = c.post(
+                "/admin/cabinet/file/upload/", {"folder": f.id, "file": truncated}
+            )
+        self.assertEqual(is_image.call_count, 0)
+        truncated = File.objects.get(file_name="truncated.png")
+        self.assertEqual(truncated.kind, "download_file")
+
+        self.assertNoMediaFiles()
+
     def test_large_upload(self):
         c = self.login()
         f = Folder.objects.create(name="Test")
@@ -461,6 +676,208 @@ class CabinetTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response.content.decode("utf-8"))["success"], True)
 
+    @override_settings(CABINET_DEDUPLICATE_FILES=True)
+    def test_deduplication(self):
+        folder = Folder.objects.create(name="Root")
+        files = []
+        for _i in range(3):
+            file = File(folder=folder)
+            file.file = ContentFile(b"Hello", name="hello.txt")
+            file.save()
+            files.append(file)
+
+        self.assertEqual(
+            files[0].file_hash,
+            "185f8db32271fe25f561a6fc938b2e264306ec304eda518007d1764826381969",
+        )
+        self.assertEqual(len({f.download_file.name for f in files}), 1)
+        self.assertEqual(len(os.listdir(os.path.dirname(files[0].file.path))), 1)
+
+        # Deduplicated uploads keep their name
+        copy = File(folder=folder)
+        copy.file = ContentFile(b"Hello", name="copy.txt")
+        copy.save()
+        self.assertEqual(copy.file.name, files[0].file.name)
+        copy = File.objects.get(pk=copy.pk)
+        copy.caption = "Copy"
+        copy.save()
+        copy.refresh_from_db()
+        self.assertEqual(copy.file_name, "copy.txt")
+        with self.captureOnCommitCallbacks(execute=True):
+            copy.delete()
+
+        other = File(folder=folder)
+        other.file = ContentFile(b"World", name="hello.txt")
+        other.save()
+        self.assertNotEqual(other.file.name, files[0].file.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            files[0].delete()
+            files[1].delete()
+        self.assertTrue(os.path.exists(files[2].file.path))
+        path = files[2].file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            files[2].delete()
+        self.assertFalse(os.path.exists(path))
+
+        self.assertNoMediaFiles()
+
+    def test_backfill_file_hashes(self):
+        folder = Folder.objects.create(name="Root")
+        old = File(folder=folder)
+        old.file = ContentFile(b"Hello", name="hello.txt")
+        old.save()
+        File.objects.update(file_hash="")
+
+        stdout = io.StringIO()
+        call_command("backfill_cabinet_file_hashes", stdout=stdout)
+        self.assertEqual(
+            stdout.getvalue(),
+            "Updated the hash of 1 files, 0 blobs could not be read.\n",
+        )
+        old.refresh_from_db()
+        self.assertEqual(
+            old.file_hash,
+            "185f8db32271fe25f561a6fc938b2e264306ec304eda518007d1764826381969",
+        )
+
+        with override_settings(CABINET_DEDUPLICATE_FILES=True):
+            new = File(folder=folder)
+            new.file = ContentFile(b"Hello", name="hello.txt")
+            new.save()
+        self.assertEqual(new.file.name, old.file.name)
+
+        self.assertNoMediaFiles()
+
+    @override_settings(CABINET_DEDUPLICATE_FILES=True)
+    def test_upload_check(self):
+        folder = Folder.objects.create(name="Root")
+        file = File(folder=folder)
+        file.file = ContentFile(b"Hello", name="hello.txt")
+        file.save()
+
+        c = self.login()
+        response = c.get(f"/admin/cabinet/file/?folder__id__exact={folder.pk}")
+        self.assertContains(
+            response, 'data-hash-worker="/static/cabinet/hash-worker.js"'
+        )
+
+        response = c.post(
+            "/admin/cabinet/file/upload/check/", "{}", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+        other = Folder.objects.create(name="Other")
+        response = c.post(
+            "/admin/cabinet/file/upload/check/",
+            {
+                "folder": other.pk,
+                "files": [
+                    {"hash": file.file_hash, "size": 5, "name": "copy.txt"},
+                    {"hash": file.file_hash, "size": 6, "name": "other.txt"},
+                    {"hash": "0" * 64, "size": 5, "name": "new.txt"},
+                ],
+            },
+            content_type="application/json",
+        )
+        data = response.json()
+        self.assertEqual([row["exists"] for row in data["files"]], [True, False, False])
+
+        copy = File.objects.get(folder=other)
+        self.assertEqual(copy.pk, data["files"][0]["pk"])
+        self.assertEqual(copy.download_file.name, file.download_file.name)
+        self.assertEqual(copy.file_name, "copy.txt")
+        self.assertEqual(copy.download_type, "txt")
+        self.assertEqual(copy.file_size, 5)
+        copy.save()
+        self.assertEqual(copy.file_name, "copy.txt")
+
+        self.assertNoMediaFiles()
+
+    def test_chunked_upload(self):
+        c = self.login()
+        f = Folder.objects.create(name="Test")
+        with open(self.image1_path, "rb") as image:
+            image1_bytes = image.read()
+
+        with (
+            tempfile.TemporaryDirectory() as tmp_dir,
+            override_settings(CABINET_UPLOAD_STAGING_DIR=tmp_dir),
+        ):
+            response = c.post(
+                "/admin/cabinet/file/upload/chunked/",
+                {"folder": f.id, "name": "image.png", "size": len(image1_bytes)},
+            )
+            upload = response.json()["upload"]
+            url = f"/admin/cabinet/file/upload/chunked/{upload}/"
+
+            response = c.put(
+                f"{url}?offset=0", image1_bytes[:1000], "application/octet-stream"
+            )
+            self.assertEqual(response.json(), {"success": True, "offset": 1000})
+
+            # Wrong offset, client has to resume at the offset returned
+            response = c.put(
+                f"{url}?offset=500", image1_bytes[500:], "application/octet-stream"
+            )
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()["offset"], 1000)
+
+            # The same chunk sent twice is only appended once; the offset is
+            # checked while holding a lock on the upload
+            with patch("cabinet.staging.locks.lock", wraps=locks.lock) as lock:
+                for _i in range(2):
+                    response = c.put(
+                        f"{url}?offset=1000",
+                        image1_bytes[1000:2000],
+                        "application/octet-stream",
+                    )
+            self.assertEqual(lock.call_count, 2)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()["offset"], 2000)
+
+            # Not complete yet
+            response = c.post(f"{url}finalize/")
+            self.assertEqual(response.status_code, 409)
+
+            response = c.put(
+                f"{url}?offset=2000", image1_bytes[2000:], "application/octet-stream"
+            )
+            self.assertEqual(response.json()["offset"], len(image1_bytes))
+
+            response = c.post(f"{url}finalize/")
+            self.assertEqual(response.json()["success"], True)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            response = c.get(url)
+            self.assertEqual(response.status_code, 404)
+
+        file = File.objects.get()
+        self.assertEqual(file.image_file.read(), image1_bytes)
+        self.assertEqual(file.file_size, len(image1_bytes))
+
+        self.assertNoMediaFiles()
+
+    def test_clean_uploads(self):
+        with (
+            tempfile.TemporaryDirectory() as tmp_dir,
+            override_settings(CABINET_UPLOAD_STAGING_DIR=tmp_dir),
+        ):
+            stale = StagedUpload.create(folder_id=1, name="stale.txt", size=5)
+            for path in [stale.part_path, stale.meta_path]:
+                os.utime(path, (0, 0))
+            fresh = StagedUpload.create(folder_id=1, name="fresh.txt", size=5)
+            Path(tmp_dir, "unrelated.txt").write_text("Unrelated")
+            os.utime(Path(tmp_dir, "unrelated.txt"), (0, 0))
+
+            stdout = io.StringIO()
+            call_command("clean_cabinet_uploads", stdout=stdout)
+            self.assertEqual(stdout.getvalue(), "Deleted 1 stale uploads.\n")
+            self.assertEqual(
+                sorted(os.listdir(tmp_dir)),
+                [f"{fresh.id}.json", f"{fresh.id}.part", "unrelated.txt"],
+            )
+
     def test_folder_editing(self):
         parent = Folder.objects.create(name="Root")
         folder = Folder.objects.create(name="Test", parent=parent)
@@ -474,6 +891,682 @@ class CabinetTestCase(TestCase):
             response, f"/admin/cabinet/file/?folder__id__exact={parent.id}"
         )
 
+    def test_folder_counters(self):
+        def counters(folder):
+            folder = Folder.objects.get(pk=folder.pk)
+            return [getattr(folder, f) for f in Folder.COUNTER_FIELDS]
+
+        root = Folder.objects.create(name="Root")
+        sub = Folder.objects.create(name="Sub", parent=root)
+        other = Folder.objects.create(name="Other", parent=root)
+
+        file = File(folder=sub)
+        file.file = ContentFile(b"Hello", name="hello.txt")
+        file.save()
+        file = File(folder=sub)
+        file.file = ContentFile(b"World!", name="world.txt")
+        file.save()
+
+        self.assertEqual(counters(root), [2, 0, 2, 11])
+        self.assertEqual(counters(sub), [0, 2, 2, 11])
+
+        file.folder = other
+        file.save()
+        self.assertEqual(counters(root), [2, 0, 2, 11])
+        self.assertEqual(counters(sub), [0, 1, 1, 5])
+        self.assertEqual(counters(other), [0, 1, 1, 6])
+
+        # Only saved fields are counted
+        file.folder = sub
+        file.file_size = 1000
+        file.caption = "Caption"
+        file.save(update_fields=["caption"])
+        self.assertEqual(counters(sub), [0, 1, 1, 5])
+        self.assertEqual(counters(other), [0, 1, 1, 6])
+        file.refresh_from_db()
+        self.assertEqual(file.folder, other)
+
+        # Moving folders moves their totals
+        new_root = Folder.objects.create(name="New root")
+        sub.parent = new_root
+        sub.save()
+        self.assertEqual(counters(root), [1, 0, 1, 6])
+        self.assertEqual(counters(new_root), [1, 0, 1, 5])
+
+        c = self.login()
+        response = c.post(
+            "/admin/cabinet/file/folder/select/",
+            {"files": [file.id], "folder": sub.id},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(counters(other), [0, 0, 0, 0])
+        self.assertEqual(counters(new_root), [1, 0, 2, 11])
+
+        response = c.get(f"/admin/cabinet/file/?folder__id__exact={new_root.id}")
+        self.assertContains(response, "(2 files, 11")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            File.objects.filter(pk=file.pk).delete()
+        self.assertEqual(counters(new_root), [1, 0, 1, 5])
+        self.assertEqual(counters(sub), [0, 1, 1, 5])
+
+        self.assertEqual(counters(root), [1, 0, 0, 0])
+
+        Folder.objects.update(num_files=7, size_recursive=0)
+        call_command("rebuild_cabinet_folder_counters", stdout=io.StringIO())
+        self.assertEqual(counters(root), [1, 0, 0, 0])
+        self.assertEqual(counters(new_root), [1, 0, 1, 5])
+        self.assertEqual(counters(sub), [0, 1, 1, 5])
+
+        # The migration adding the counters fills them in too
+        migration = importlib.import_module("cabinet.migrations.0008_folder_counters")
+        Folder.objects.update(
+            num_subfolders=0, num_files=0, num_files_recursive=0, size_recursive=0
+        )
+        migration.fill_counters(django_apps, None)
+        self.assertEqual(counters(root), [1, 0, 0, 0])
+        self.assertEqual(counters(new_root), [1, 0, 1, 5])
+        self.assertEqual(counters(sub), [0, 1, 1, 5])
+
+        sub = Folder.objects.get(pk=sub.pk)
+        self.assertNoMediaFiles()
+        self.assertEqual(counters(new_root), [1, 0, 0, 0])
+
+        # Deleting uses the current counters, not those of the instance
+        sub.delete()
+        self.assertEqual(counters(new_root), [0, 0, 0, 0])
+
+    def test_folder_paths(self):
+        root = Folder.objects.create(name="Root")
+        sub = Folder.objects.create(name="Sub", parent=root)
+        subsub = Folder.objects.create(name="Subsub", parent=sub)
+        other = Folder.objects.create(name="Other")
+
+        self.assertEqual(subsub.path, f"{root.pk}/{sub.pk}/{subsub.pk}/")
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                list(subsub.ancestors_including_self()), [root, sub, subsub]
+            )
+        self.assertEqual(set(root.descendants_including_self()), {root, sub, subsub})
+
+        sub.parent = other
+        sub.save()
+        subsub.refresh_from_db()
+        self.assertEqual(subsub.path, f"{other.pk}/{sub.pk}/{subsub.pk}/")
+        self.assertEqual(set(root.descendants_including_self()), {root})
+        self.assertEqual(set(other.descendants_including_self()), {other, sub, subsub})
+
+        # Folders are only moved if the parent is saved
+        subsub.parent = root
+        subsub.name = "Renamed"
+        subsub.save(update_fields=["name"])
+        subsub.refresh_from_db()
+        self.assertEqual((subsub.name, subsub.parent), ("Renamed", sub))
+        self.assertEqual(subsub.path, f"{other.pk}/{sub.pk}/{subsub.pk}/")
+        root.refresh_from_db()
+        self.assertEqual(root.num_subfolders, 0)
+
+        file = File(folder=subsub)
+        file.file = ContentFile(b"Hello", name="hello.txt")
+        file.save()
+
+        c = self.login()
+        response = c.get(f"/admin/cabinet/file/?folder__id__exact={other.pk}&q=hello")
+        self.assertContains(response, "hello.txt")
+        response = c.get(f"/admin/cabinet/file/?folder__id__exact={root.pk}&q=hello")
+        self.assertNotContains(response, "hello.txt")
+
+        self.assertNoMediaFiles()
+
+    def test_folder_path_edge_cases(self):
+        root = Folder.objects.create(name="Root")
+        # Folders inserted without save() have no path
+        raw = Folder.objects.bulk_create([Folder(name="Raw", parent=root)])[0]
+        raw = Folder.objects.get(pk=raw.pk)
+        self.assertEqual(raw.path, "")
+        self.assertEqual(set(raw.descendants_including_self()), {raw})
+        self.assertEqual(raw.path, f"{root.pk}/{raw.pk}/")
+        self.assertEqual(Folder.objects.get(pk=raw.pk).path, raw.path)
+        with self.assertRaises(ValueError):
+            Folder(name="Unsaved").descendants_including_self()
+
+        # The length of the path limits the depth of the tree
+        Folder.objects.filter(pk=root.pk).update(path="1234567/" * 31 + "123456/")
+        count = Folder.objects.count()
+        with self.assertRaises(ValidationError), transaction.atomic():
+            Folder.objects.create(name="Deep", parent=root)
+        self.assertEqual(Folder.objects.count(), count)
+
+        form = modelform_factory(Folder, fields=["parent", "name"])(
+            {"parent": root.pk, "name": "Deep"}
+        )
+        self.assertEqual(
+            form.errors, {"parent": ["Folders cannot be nested this deeply."]}
+        )
+
+        other = Folder.objects.create(name="Other")
+        other.parent = root
+        with self.assertRaises(ValidationError), transaction.atomic():
+            other.save()
+        self.assertIsNone(Folder.objects.get(pk=other.pk).parent_id)
+
+        # The migration adding the paths refuses to truncate them
+        migration = importlib.import_module("cabinet.migrations.0009_folder_path")
+        migration.fill_paths(django_apps, None)
+        chain = Folder.objects.bulk_create(
+            [Folder(name=f"Chain {i}") for i in range(130)]
+        )
+        for parent, child in itertools.pairwise(chain):
+            child.parent = parent
+        Folder.objects.bulk_update(chain, ["parent"])
+        with self.assertRaisesMessage(RuntimeError, "longer than 255 characters"):
+            migration.fill_paths(django_apps, None)
+
+    def test_keyset_pagination(self):
+        folder = Folder.objects.create(name="Root")
+        for name in ["e", "a", "c", "b", "d"]:
+            file = File(folder=folder)
+            file.file = ContentFile(b"Hello", name=f"{name}.txt")
+            file.save()
+        a, b, c, d, e = File.objects.order_by("file_name")
+
+        client = self.login()
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.id}"
+        with (
+            patch.object(FileAdmin, "keyset_pagination", new=True),
+            patch.object(FileAdmin, "list_per_page", 2),
+        ):
+            response = client.get(url)
+            self.assertEqual(list(response.context["cl"].result_list), [a, b])
+            self.assertIsNone(response.context["cl"].previous_page_url)
+
+            response = client.get(
+                "/admin/cabinet/file/" + response.context["cl"].next_page_url
+            )
+            self.assertEqual(list(response.context["cl"].result_list), [c, d])
+            self.assertContains(response, "5 files")
+
+            response = client.get(
+                "/admin/cabinet/file/" + response.context["cl"].next_page_url
+            )
+            self.assertEqual(list(response.context["cl"].result_list), [e])
+            self.assertIsNone(response.context["cl"].next_page_url)
+
+            response = client.get(
+                "/admin/cabinet/file/" + response.context["cl"].previous_page_url
+            )
+            self.assertEqual(list(response.context["cl"].result_list), [c, d])
+
+            response = client.get(
+                "/admin/cabinet/file/" + response.context["cl"].previous_page_url
+            )
+            self.assertEqual(list(response.context["cl"].result_list), [a, b])
+            self.assertIsNone(response.context["cl"].previous_page_url)
+
+            # The cursor isn't kept when changing folders
+            response = client.get(f"{url}&after={b.pk}")
+            self.assertEqual(response.context["cabinet"]["querystring"], "")
+
+            response = client.get(f"{url}&after=0")
+            self.assertRedirects(response, "/admin/cabinet/file/?e=1")
+
+            # Sorting by a column uses regular pagination
+            with patch.object(
+                FileAdmin, "list_display", [*FileAdmin.list_display, "file_name"]
+            ):
+                response = client.get(f"{url}&o=-4")
+            self.assertFalse(response.context["cl"].keyset_pagination)
+            self.assertEqual(list(response.context["cl"].result_list), [e, d])
+
+        # Outdated counters never decide which files are listed
+        Folder.objects.filter(pk=folder.pk).update(num_files=0)
+        with patch.object(FileAdmin, "list_per_page", 2):
+            response = client.get(url)
+            self.assertEqual(list(response.context["cl"].result_list), [a, b])
+            self.assertTrue(response.context["cl"].multi_page)
+            self.assertTrue(response.context["cl"].can_show_all)
+
+            response = client.get(f"{url}&p=3")
+            self.assertEqual(list(response.context["cl"].result_list), [e])
+
+            response = client.get(f"{url}&p=4")
+            self.assertRedirects(response, "/admin/cabinet/file/?e=1")
+
+            with patch.object(FileAdmin, "list_max_show_all", 4):
+                response = client.get(f"{url}&all=")
+            self.assertFalse(response.context["cl"].can_show_all)
+            self.assertEqual(list(response.context["cl"].result_list), [a, b])
+
+        self.assertNoMediaFiles()
+
+    def test_result_counts(self):
+        cache.clear()
+        folder = Folder.objects.create(name="Root")
+        for name in ["a", "b", "c"]:
+            file = File(folder=folder)
+            file.file = ContentFile(b"Hello", name=f"{name}.txt")
+            file.save()
+
+        client = self.login()
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.id}"
+
+        # The folder's counter is used instead of counting
+        Folder.objects.filter(pk=folder.pk).update(num_files=42)
+        response = client.get(url)
+        self.assertEqual(response.context["cl"].result_count, 42)
+        self.assertEqual(response.context["cl"].full_result_count, 3)
+        Folder.objects.filter(pk=folder.pk).update(num_files=3)
+
+        with patch.object(FileAdmin, "search_result_count_limit", 2):
+            response = client.get(f"{url}&q=txt")
+        self.assertEqual(response.context["cl"].result_count, 2)
+        self.assertTrue(response.context["cl"].result_count_capped)
+        self.assertContains(response, "2+ files")
+
+        # The total is cached
+        with self.captureOnCommitCallbacks(execute=True):
+            File.objects.filter(file_name="a.txt").delete()
+        response = client.get(url)
+        self.assertEqual(response.context["cl"].result_count, 2)
+        self.assertEqual(response.context["cl"].full_result_count, 3)
+
+        self.assertNoMediaFiles()
+
+    def test_search_backends(self):
+        folder = Folder.objects.create(name="Root")
+        for name, caption in [
+            ("holiday.txt", ""),
+            ("report.txt", "Holiday photos"),
+            ("other.txt", "Nothing"),
+        ]:
+            file = File(folder=folder, caption=caption)
+            file.file = ContentFile(b"Hello", name=name)
+            file.save()
+
+        client = self.login()
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.id}&q="
+
+        response = client.get(f"{url}holiday")
+        self.assertEqual(
+            [f.file_name for f in response.context["cl"].result_list],
+            ["holiday.txt", "report.txt"],
+        )
+
+        with override_settings(
+            CABINET_SEARCH_BACKEND="cabinet.search.SQLiteFTS5SearchBackend"
+        ):
+            # Files existing before switching backends are indexed by the
+            # management command
+            call_command("rebuild_cabinet_search_index", stdout=io.StringIO())
+
+            response = client.get(f"{url}holiday")
+            self.assertEqual(
+                {f.file_name for f in response.context["cl"].result_list},
+                {"holiday.txt", "report.txt"},
+            )
+
+            # The table isn't created again and again
+            with CaptureQueriesContext(connection) as queries:
+                file.caption = "Holiday, too"
+                file.save()
+                client.get(f"{url}holiday")
+            self.assertFalse(any("CREATE" in q["sql"] for q in queries))
+
+            response = client.get(f"{url}iday+ther")
+            self.assertEqual(
+                [f.file_name for f in response.context["cl"].result_list],
+                ["other.txt"],
+            )
+
+            # Files without primary keys (bulk_create() on some databases)
+            # are indexed using their blobs
+            unindexed = File(folder=folder, caption="Unindexed")
+            unindexed.file = ContentFile(b"Unindexed", name="unindexed.txt")
+            unindexed.save()
+            get_search_backend().remove([unindexed])
+            response = client.get(f"{url}unindexed")
+            self.assertEqual(len(response.context["cl"].result_list), 0)
+
+            get_search_backend().index(
+                [File(download_file=unindexed.download_file.name)]
+            )
+            response = client.get(f"{url}unindexed")
+            self.assertEqual(list(response.context["cl"].result_list), [unindexed])
+            with self.captureOnCommitCallbacks(execute=True):
+                unindexed.delete()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                file.delete()
+            response = client.get(f"{url}holiday")
+            self.assertEqual(len(response.context["cl"].result_list), 2)
+
+        # The admin's search_fields are searched
+        with patch.object(FileAdmin, "search_fields", ["^file_name"]):
+            response = client.get(f"{url}holiday")
+        self.assertEqual(
+            [f.file_name for f in response.context["cl"].result_list],
+            ["holiday.txt"],
+        )
+
+        self.assertNoMediaFiles()
+
+    def test_file_kind(self):
+        folder = Folder.objects.create(name="Root")
+        with open(self.image1_path, "rb") as image:
+            image_file = File(folder=folder)
+            image_file.file = ContentFile(image.read(), name="image.png")
+            image_file.save()
+        download_file = File(folder=folder)
+        download_file.file = ContentFile(b"Hello", name="hello.txt")
+        download_file.save()
+
+        self.assertEqual(image_file.kind, "image_file")
+        self.assertEqual(download_file.kind, "download_file")
+
+        c = self.login()
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.pk}&file_type="
+        response = c.get(f"{url}image_file")
+        self.assertEqual(list(response.context["cl"].result_list), [image_file])
+        response = c.get(f"{url}download_file")
+        self.assertEqual(list(response.context["cl"].result_list), [download_file])
+
+        File.objects.update(kind="")
+        call_command("backfill_cabinet_file_kind", batch_size=1, stdout=io.StringIO())
+        self.assertEqual(
+            dict(File.objects.values_list("file_name", "kind")),
+            {"image.png": "image_file", "hello.txt": "download_file"},
+        )
+
+        self.assertNoMediaFiles()
+
+    def test_batched_deletion(self):
+        folder = Folder.objects.create(name="Root")
+        paths = []
+        for name in ["a", "b", "c"]:
+            file = File(folder=folder)
+            file.file = ContentFile(b"Hello", name=f"{name}.txt")
+            file.save()
+            paths.append(file.file.path)
+
+        with (
+            patch(
+                "cabinet.deletion.unreferenced_files", wraps=unreferenced_files
+            ) as check,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            File.objects.filter(file_name__in=["a.txt", "b.txt"]).delete()
+            # Blobs are only deleted after the transaction has been committed
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+        # All blobs are checked and deleted together
+        self.assertEqual(check.call_count, 1)
+        self.assertEqual(len(check.call_args[0][0]), 2)
+        self.assertEqual([os.path.exists(path) for path in paths], [False, False, True])
+
+        # Blobs of files deleted in a transaction which is rolled back are kept
+        other = File(folder=folder)
+        other.file = ContentFile(b"Other", name="other.txt")
+        other.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                File.objects.filter(file_name="c.txt").delete()
+                transaction.set_rollback(True)
+            other.delete()
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertFalse(os.path.exists(other.file.path))
+
+        # Failures are logged but do not roll back the deletion
+        with (
+            patch(
+                "django.core.files.storage.FileSystemStorage.delete",
+                side_effect=OSError("Nope"),
+            ),
+            self.assertLogs("cabinet.deletion", "ERROR") as logs,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            File.objects.all().delete()
+        self.assertIn("Deleting cabinet/", logs.output[0])
+        self.assertEqual(File.objects.count(), 0)
+
+        # Storages may delete blobs in bulk
+        file = File(folder=folder)
+        file.file = ContentFile(b"Hello", name="d.txt")
+        file.save()
+        with (
+            patch(
+                "django.core.files.storage.FileSystemStorage.delete_many",
+                create=True,
+            ) as delete_many,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            file.delete()
+        delete_many.assert_called_once_with([file.download_file.name])
+
+        shutil.rmtree(settings.MEDIA_ROOT)
+        self.assertNoMediaFiles()
+
+    @override_settings(CABINET_DELETION_QUEUE=True)
+    def test_deletion_queue(self):
+        folder = Folder.objects.create(name="Root")
+        file = File(folder=folder)
+        file.file = ContentFile(b"Hello", name="hello.txt")
+        file.save()
+        name, path = file.file.name, file.file.path
+
+        # Nothing is recorded when the transaction is rolled back
+        with self.assertRaises(ZeroDivisionError), transaction.atomic():
+            File.objects.all().delete()
+            self.assertEqual(PendingDeletion.objects.count(), 1)
+            1 / 0  # noqa: B018
+        self.assertEqual(PendingDeletion.objects.count(), 0)
+
+        # Replacing the file records the deletion of the old blob
+        file.file = ContentFile(b"World", name="world.txt")
+        file.save()
+        self.assertEqual(
+            list(PendingDeletion.objects.values_list("field", "name")),
+            [("cabinet.File.download_file", name)],
+        )
+        self.assertTrue(os.path.exists(path))
+
+        with (
+            patch(
+                "django.core.files.storage.FileSystemStorage.delete",
+                side_effect=OSError("Nope"),
+            ),
+            self.assertLogs("cabinet.deletion", "ERROR"),
+        ):
+            call_command("process_cabinet_deletions", stdout=io.StringIO())
+        entry = PendingDeletion.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn("Nope", entry.last_error)
+        self.assertTrue(os.path.exists(path))
+
+        # The next attempt happens after a minute
+        PendingDeletion.objects.update(next_attempt_at=timezone.now())
+        file.delete()
+        stdout = io.StringIO()
+        call_command("process_cabinet_deletions", stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "Deleted 2 blobs, 0 deletions failed.\n")
+        self.assertEqual(PendingDeletion.objects.count(), 0)
+
+        self.assertNoMediaFiles()
+
+    def test_renditions(self):
+        client = self.login()
+        folder = Folder.objects.create(name="Test")
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.id}"
+
+        with (
+            open(self.image1_path, "rb") as image,
+            self.captureOnCommitCallbacks(execute=True) as callbacks,
+        ):
+            client.post(
+                "/admin/cabinet/file/upload/batch/",
+                {"folder": folder.id, "files": [image]},
+            )
+        self.assertEqual(len(callbacks), 1)
+
+        # The changelist never decodes originals and looks up the state of
+        # all thumbnails at once
+        with (
+            patch("imagefield.fields.ImageFieldFile._process") as process,
+            patch("django.core.files.storage.FileSystemStorage.exists") as exists,
+            patch.object(cache, "get_many", wraps=cache.get_many) as get_many,
+        ):
+            response = client.get(url)
+        self.assertEqual(process.call_count, 0)
+        self.assertEqual(exists.call_count, 0)
+        self.assertEqual(get_many.call_count, 1)
+        self.assertContains(response, '<img src="/media/__processed__/')
+
+        # Renditions which are missing are generated in the background
+        cache.clear()
+        file = File.objects.get()
+        file.image_file.field._clear_generated_files_for(file.image_file, None)
+        with (
+            override_settings(CABINET_RENDITION_WORKERS=1),
+            patch("cabinet.renditions._get_executor") as get_executor,
+        ):
+            response = client.get(url)
+            self.assertContains(response, '<span class="pending-image"></span>')
+            response = client.get(url)
+            self.assertContains(response, '<span class="pending-image"></span>')
+        self.assertEqual(get_executor.return_value.submit.call_count, 1)
+
+        self.assertNoMediaFiles()
+
+    @override_settings(
+        CABINET_RENDITION_WORKERS=1,
+        IMAGEFIELD_FORMATS={"cabinet.file.image_file": {"square": ["default"]}},
+    )
+    def test_renditions_not_generated_in_request(self):
+        file = File(folder=Folder.objects.create(name="Test"))
+        with (
+            open(self.image1_path, "rb") as image,
+            patch("imagefield.fields.ImageFieldFile._process") as process,
+            patch("cabinet.renditions._get_executor") as get_executor,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            file.image_file = ContentFile(image.read(), name="image.png")
+            file.save()
+
+        self.assertEqual(process.call_count, 0)
+        self.assertEqual(get_executor.return_value.submit.call_count, 1)
+
+        # Saving again generates missing formats like django-imagefield does
+        # without cabinet
+        file = File.objects.get(pk=file.pk)
+        file.caption = "Caption"
+        with patch("imagefield.fields.ImageFieldFile.process") as process:
+            file.save()
+        self.assertEqual(process.call_count, 1)
+
+        self.assertNoMediaFiles()
+
+    def test_regenerate_renditions(self):
+        folder = Folder.objects.create(name="Root")
+        other = Folder.objects.create(name="Other")
+        files = []
+        for f in [folder, folder, other]:
+            file = File(folder=f)
+            with open(self.image1_path, "rb") as image:
+                file.image_file.save("image.png", ContentFile(image.read()))
+            files.append(file)
+
+        def thumbnail_exists(file):
+            name = rendition_name(file.image_file, ADMIN_THUMBNAIL)
+            return file.image_file.storage.exists(name)
+
+        self.assertEqual(
+            [thumbnail_exists(file) for file in files], [False, False, False]
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint = Path(tmp_dir) / "checkpoint"
+            # Resume after the first file
+            checkpoint.write_text(str(files[0].pk))
+
+            stdout, stderr = io.StringIO(), io.StringIO()
+            call_command(
+                "regenerate_cabinet_renditions",
+                f"--folder={folder.pk}",
+                f"--checkpoint={checkpoint}",
+                "--workers=2",
+                stdout=stdout,
+                stderr=stderr,
+            )
+            self.assertEqual(
+                [thumbnail_exists(file) for file in files], [False, True, False]
+            )
+            self.assertIn(f"Resuming after file {files[0].pk}", stderr.getvalue())
+            self.assertIn("1 images processed", stderr.getvalue())
+            self.assertEqual(
+                stdout.getvalue(),
+                "Processed 1 images, 0 renditions could not be generated.\n",
+            )
+            self.assertFalse(checkpoint.exists())
+
+        call_command(
+            "regenerate_cabinet_renditions",
+            "--since=2000-01-01",
+            "--workers=1",
+            "--batch-size=1",
+            stdout=stdout,
+            stderr=io.StringIO(),
+        )
+        self.assertEqual([thumbnail_exists(file) for file in files], [True, True, True])
+
+        with self.assertRaisesMessage(CommandError, "Folder 0 does not exist"):
+            call_command("regenerate_cabinet_renditions", "--folder=0")
+
+        self.assertNoMediaFiles()
+
+    def test_move_selection(self):
+        folder = Folder.objects.create(name="Root")
+        target = Folder.objects.create(name="Target")
+        for name in ["a", "b", "c"]:
+            file = File(folder=folder)
+            file.file = ContentFile(b"Hello", name=f"{name}.txt")
+            file.save()
+
+        client = self.login()
+        url = f"/admin/cabinet/file/?folder__id__exact={folder.id}&q=b"
+        response = client.post(
+            url,
+            {
+                "action": "move_to_folder",
+                "select_across": "1",
+                "index": "0",
+                "_selected_action": [file.pk],
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("?selection=", response["Location"])
+
+        response = client.get(response["Location"])
+        self.assertContains(response, "Move 1 file (5")
+        self.assertContains(response, "<li>b.txt</li>")
+        self.assertNotContains(response, 'id="id_files_0"')
+
+        selection_url = response.wsgi_request.get_full_path()
+        response = client.post(selection_url, {"folder": target.pk})
+        self.assertRedirects(
+            response, f"/admin/cabinet/file/?folder__id__exact={target.pk}"
+        )
+        self.assertEqual(
+            dict(File.objects.values_list("file_name", "folder")),
+            {"a.txt": folder.pk, "b.txt": target.pk, "c.txt": folder.pk},
+        )
+        target.refresh_from_db()
+        self.assertEqual(target.num_files, 1)
+
+        # Selections are only used once
+        response = client.post(selection_url, {"folder": folder.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(File.objects.filter(folder=target).count(), 1)
+
+        self.assertNoMediaFiles()
+
     def test_last_folder(self):
         folder = Folder.objects.create(name="Root")
 
@@ -527,6 +1620,7 @@ class CabinetTestCase(TestCase):
         f1 = File.objects.get()
         self.assertEqual(f1.image_file, "")
 
+    @isolate_apps("testapp")
     def test_custom_file(self):
         class NonModelMixin:
             pass
@@ -553,8 +1647,45 @@ class CabinetTestCase(TestCase):
             ],
         )
 
+    def test_classify(self):
+        self.assertEqual(File.classify("image.JPG"), "image")
+        self.assertEqual(File.classify("archive.tar.gz"), "other")
+        self.assertEqual(File.classify("report", b"%PDF-1.7\n"), "pdf")
+        self.assertEqual(File.classify("report.pdf", b"PK\x03\x04"), "pdf")
+        self.assertEqual(File.classify("clip", b"\x00\x00\x00\x18ftypmp42"), "video")
+        self.assertIs(File.download_type_classifier(), File.download_type_classifier())
+
+        # Callables are still supported and evaluated in order
+        classifier = DownloadTypeClassifier(
+            [
+                ("special", "Special", lambda f: f.startswith("special")),
+                ("image", "Image", (".jpg",)),
+                ("late", "Late", lambda f: f.endswith(".jpg")),
+                ("other", "Binary", lambda f: True),
+            ]
+        )
+        self.assertEqual(classifier("special.jpg"), "special")
+        self.assertEqual(classifier("image.jpg"), "image")
+        self.assertEqual(classifier("file", b"%PDF-"), "other")
+
+        folder = Folder.objects.create(name="Root")
+        file = File(folder=folder)
+        file.file = ContentFile(b"%PDF-1.7\n", name="report")
+        file.save()
+        self.assertEqual(file.download_type, "pdf")
+
+        # Saving again keeps the sniffed type
+        file.save()
+        self.assertEqual(file.download_type, "pdf")
+        file = File.objects.get()
+        file.caption = "Report"
+        file.save()
+        self.assertEqual(File.objects.get().download_type, "pdf")
+
+        self.assertNoMediaFiles()
+
     @patch(
-        "cabinet.management.commands.archive_cabinet_folder._get_random_suffix",
+        "cabinet.archive._get_random_suffix",
         return_value="asdf",
     )
     def test_archive_management_command(self, patched__get_random_suffix):
@@ -568,10 +1699,19 @@ class CabinetTestCase(TestCase):
 
         # enforce duplicate names
         File.objects.all().update(file_name="hello.txt")
+        # Both files reference the same blob, e.g. when using deduplication
+        first, second = File.objects.order_by("pk")
+        second.download_file.delete(save=False)
+        File.objects.filter(pk=second.pk).update(download_file=first.download_file.name)
 
         with tempfile.TemporaryDirectory() as tmp_dir:
             output = Path(tmp_dir) / "output.zip"
-            call_command("archive_cabinet_folder", folder_id=folder.id, output=output)
+            call_command(
+                "archive_cabinet_folder",
+                folder_id=folder.id,
+                output=output,
+                verbosity=0,
+            )
             with ZipFile(output, "r") as zip_file:
                 self.assertEqual(
                     zip_file.namelist(),
@@ -580,3 +1720,220 @@ class CabinetTestCase(TestCase):
                         "Top/Sub/hello_asdf.txt",
                     ],
                 )
+
+        file = File(folder=folder)
+        with Path(self.image1_path).open("rb") as image:
+            file.image_file.save("image.png", ContentFile(image.read()))
+
+        # Writing to stdout; compressed formats are stored as-is
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with self.assertNumQueries(3):
+            call_command(
+                "archive_cabinet_folder",
+                folder_id=folder.id,
+                output="-",
+                stdout=stdout,
+                verbosity=0,
+            )
+        with ZipFile(io.BytesIO(stdout.buffer.getvalue()), "r") as zip_file:
+            self.assertEqual(
+                [(info.filename, info.compress_type) for info in zip_file.infolist()],
+                [
+                    ("Top/image.png", ZIP_STORED),
+                    ("Top/Sub/hello.txt", ZIP_DEFLATED),
+                    ("Top/Sub/hello_asdf.txt", ZIP_DEFLATED),
+                ],
+            )
+            self.assertEqual(zip_file.read("Top/Sub/hello.txt"), b"Hello")
+
+        # Volumes, parallel reads and resuming
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            stderr = io.StringIO()
+            call_command(
+                "archive_cabinet_folder",
+                "--volume-size=10",
+                folder_id=folder.id,
+                output=Path(tmp_dir) / "archive.zip",
+                workers=2,
+                stderr=stderr,
+            )
+            self.assertIn("Archived 3 files", stderr.getvalue())
+            self.assertIn("into 3 volume(s)", stderr.getvalue())
+
+            # Interrupted while writing the last volume
+            volumes = sorted(Path(tmp_dir).iterdir())
+            self.assertEqual(
+                [volume.name for volume in volumes],
+                ["archive.001.zip", "archive.002.zip", "archive.003.zip"],
+            )
+            names = []
+            for volume in volumes:
+                with ZipFile(volume) as zip_file:
+                    names.extend(zip_file.namelist())
+            volumes[-1].write_bytes(volumes[-1].read_bytes()[:20])
+
+            stderr = io.StringIO()
+            call_command(
+                "archive_cabinet_folder",
+                "--resume",
+                "--volume-size=10",
+                folder_id=folder.id,
+                output=Path(tmp_dir) / "archive.zip",
+                stderr=stderr,
+            )
+            self.assertIn("Archived 1 files", stderr.getvalue())
+            with ZipFile(volumes[-1]) as zip_file:
+                self.assertEqual(zip_file.namelist(), names[-1:])
+
+        # Streamed download in the admin
+        client = self.login()
+        response = client.get(f"/admin/cabinet/file/?folder__id__exact={folder.id}")
+        url = reverse("admin:cabinet_folder_download", args=(folder.id,))
+        self.assertContains(response, f'<a href="{url}">Download as ZIP</a>')
+        response = client.get(url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            response["Content-Disposition"], "attachment; filename*=utf-8''Top.zip"
+        )
+        with ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zip_file:
+            self.assertEqual(
+                zip_file.namelist(),
+                ["Top/image.png", "Top/Sub/hello.txt", "Top/Sub/hello_asdf.txt"],
+            )
+            self.assertEqual(zip_file.read("Top/Sub/hello_asdf.txt"), b"Hello")
+
+        self.assertNoMediaFiles()
+
+    def test_check_files(self):
+        folder = Folder.objects.create(name="Root")
+        image = File(folder=folder)
+        with open(self.image1_path, "rb") as f:
+            image.image_file.save("image.png", ContentFile(f.read()))
+        text = File(folder=folder)
+        text.file = ContentFile(b"Hello", name="hello.txt")
+        text.save()
+        gone = File(folder=folder)
+        gone.file = ContentFile(b"Gone", name="gone.txt")
+        gone.save()
+        gone.file.storage.delete(gone.file.name)
+
+        size, width = image.file_size, image.image_width
+        File.objects.filter(pk=image.pk).update(file_size=1, image_width=1)
+        File.objects.filter(pk=text.pk).update(download_type="pdf")
+        File.update_folder_counters(folder.pk, 0, 1 - image.file_size)
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command("check_cabinet_files", "--workers=2", stdout=stdout, stderr=stderr)
+        problems = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(
+            problems,
+            [
+                {
+                    "pk": image.pk,
+                    "name": image.image_file.name,
+                    "error": "",
+                    "changes": {
+                        "file_size": [1, image.file_size],
+                        "image_width": [1, image.image_width],
+                    },
+                },
+                {
+                    "pk": text.pk,
+                    "name": text.file.name,
+                    "error": "",
+                    "changes": {"download_type": ["pdf", "txt"]},
+                },
+                {
+                    "pk": gone.pk,
+                    "name": gone.file.name,
+                    "error": "missing",
+                    "changes": {},
+                },
+            ],
+        )
+        self.assertEqual(
+            stderr.getvalue(), "Checked 3 files, found 3 problems, fixed 0.\n"
+        )
+
+        # Files changed while being checked are left alone
+        fix = CheckFilesCommand._fix
+
+        def change_meanwhile(command, results, rows):
+            File.objects.filter(pk=text.pk).update(download_type="zip")
+            return fix(command, results, rows)
+
+        with patch.object(
+            CheckFilesCommand, "_fix", autospec=True, side_effect=change_meanwhile
+        ):
+            call_command(
+                "check_cabinet_files",
+                "--fix",
+                "--batch-size=2",
+                stdout=stdout,
+                stderr=stderr,
+            )
+        self.assertIn("Checked 3 files, found 3 problems, fixed 1.", stderr.getvalue())
+        image.refresh_from_db()
+        text.refresh_from_db()
+        self.assertEqual((image.file_size, image.image_width), (size, width))
+        self.assertEqual(text.download_type, "zip")
+
+        call_command("check_cabinet_files", "--fix", stdout=stdout, stderr=stderr)
+        self.assertIn("Checked 3 files, found 2 problems, fixed 1.", stderr.getvalue())
+        text.refresh_from_db()
+        self.assertEqual(text.download_type, "txt")
+        folder.refresh_from_db()
+        self.assertEqual(folder.size_recursive, image.file_size + 5 + 4)
+
+        self.assertNoMediaFiles()
+
+    def test_find_orphans(self):
+        folder = Folder.objects.create(name="Root")
+        file = File(folder=folder)
+        file.file = ContentFile(b"Hello", name="hello.txt")
+        file.save()
+        storage = file.file.storage
+        old = storage.save("cabinet/2020/01/old.txt", ContentFile(b"Old"))
+        os.utime(storage.path(old), (0, 0))
+        new = storage.save("cabinet/2020/01/new.txt", ContentFile(b"New"))
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command(
+            "find_cabinet_orphans", "--batch-size=2", stdout=stdout, stderr=stderr
+        )
+        self.assertEqual(stdout.getvalue(), f"{old}\n")
+        self.assertEqual(
+            stderr.getvalue(),
+            "Listed 3 blobs, found 1 orphans (0.0 MiB), deleted 0,"
+            " 0 deletions failed.\n",
+        )
+
+        # The whole storage is never walked
+        field = File._meta.get_field("download_file")
+        with patch.object(field, "upload_to", lambda instance, name: name):
+            with self.assertRaisesMessage(CommandError, "pass --prefix"):
+                call_command("find_cabinet_orphans", stdout=stdout, stderr=stderr)
+            with self.assertRaisesMessage(CommandError, "pass --prefix"):
+                call_command("find_cabinet_orphans", "--prefix=/", stdout=stdout)
+
+            stderr = io.StringIO()
+            call_command(
+                "find_cabinet_orphans",
+                "--prefix=cabinet/2020",
+                stdout=io.StringIO(),
+                stderr=stderr,
+            )
+            self.assertIn("Listed 2 blobs, found 1 orphans", stderr.getvalue())
+
+        call_command(
+            "find_cabinet_orphans",
+            "--delete",
+            "--grace-period=0",
+            stdout=stdout,
+            stderr=io.StringIO(),
+        )
+        self.assertFalse(storage.exists(old))
+        self.assertFalse(storage.exists(new))
+        self.assertTrue(storage.exists(file.file.name))
+
+        self.assertNoMediaFiles()